@@ -0,0 +1,125 @@
+import asyncio
+import concurrent.futures
+import socket
+import threading
+from collections import deque
+
+
+class AsyncSockInstError(Exception):
+    pass
+
+
+class AsyncSocketInstrument():
+    # Drop-in for socketscpi.SocketInstrument backed by asyncio streams on a private event loop.
+    # Any number of queries can be in flight, each with its own timeout, and cancel() releases
+    # every blocked caller at once.
+
+    def __init__(self, ip_address: str, port: int = 5025, timeout: float = 10.0):
+        self.ip_address = ip_address
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        # Futures waiting on a response line, oldest first
+        self.pending = deque()
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        try:
+            self.run(self.open(), timeout)
+            self.instId = self.query('*IDN?')
+        except:
+            self.close()
+            raise
+
+    def run(self, coroutine, timeout: float = None):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.ip_address, self.port)
+        self.writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader_task = self.loop.create_task(self.readResponses())
+
+    async def readResponses(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    raise ConnectionResetError('Instrument closed the connection')
+                # SCPI answers strictly in order, so the oldest query owns this line.
+                # A query that timed out or was cancelled still owns its answer, which is dropped.
+                if self.pending:
+                    future = self.pending.popleft()
+                    if not future.done():
+                        future.set_result(line.decode('latin_1').strip())
+        except asyncio.CancelledError:
+            self.failPending(AsyncSockInstError('Connection closed'))
+            raise
+        except Exception as e:
+            self.failPending(e)
+
+    def failPending(self, error: Exception):
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+    async def send(self, cmd: str):
+        if self.writer is None or self.writer.is_closing():
+            raise AsyncSockInstError('Not connected')
+        self.writer.write(f'{cmd}\n'.encode('latin_1'))
+        await self.writer.drain()
+
+    async def sendQuery(self, cmd: str, timeout: float):
+        # Queued before the write so a reply that lands during drain() still finds its query
+        future = self.loop.create_future()
+        self.pending.append(future)
+        try:
+            await self.send(cmd)
+        except BaseException:
+            # A failed send must not leave the query to take the next reply
+            if future in self.pending:
+                self.pending.remove(future)
+            future.cancel()
+            raise
+        return await asyncio.wait_for(future, timeout)
+
+    def write(self, cmd: str):
+        self.run(self.send(cmd), self.timeout)
+
+    def queryAsync(self, cmd: str, timeout: float = None) -> concurrent.futures.Future:
+        # Returns immediately, the future can be waited on, cancelled or given callbacks
+        return asyncio.run_coroutine_threadsafe(self.sendQuery(cmd, self.timeout if timeout is None else timeout), self.loop)
+
+    def query(self, cmd: str, timeout: float = None) -> str:
+        return self.queryAsync(cmd, timeout).result()
+
+    def cancel(self):
+        # Fail every outstanding query with CancelledError, their answers are discarded on arrival
+        def cancelPending():
+            for future in self.pending:
+                future.cancel()
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(cancelPending)
+
+    def close(self):
+        async def shutdown():
+            if self.reader_task is not None:
+                self.reader_task.cancel()
+            if self.writer is not None:
+                self.writer.close()
+        if self.loop.is_closed():
+            return
+        try:
+            self.run(shutdown(), self.timeout)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
@@ -0,0 +1,160 @@
+import os
+import re
+import threading
+import numpy as np
+
+# One point of an open loop scan: frequency in Hz and 20 log10(V/m) - dBm at that frequency
+TRANSFER_DTYPE = np.dtype([('frequency', '<f8'), ('transfer', '<f4')])
+
+
+def equipmentKey(amplifier: str, antenna: str) -> str:
+    # File name safe key for an amplifier and antenna pair
+    return '__'.join(re.sub(r'[^A-Za-z0-9.-]+', '_', name).strip('_') for name in (amplifier, antenna))
+
+
+class FieldCalibration():
+    # Feed-forward table of the power it takes to make 1 V/m at each frequency, learned from the
+    # settled power at the end of previous sweep steps. Field goes with the square root of power,
+    # so any other field needs 20 log10(field) dB on top. Predictions interpolate linearly in log
+    # frequency and hold the end values outside the table.
+
+    def __init__(self, path: str = 'field_calibration.npz', resolution: float = 0.001, max_weight: int = 8):
+        # None keeps the table in memory only
+        self.path = path
+        # Points closer than this fraction of their frequency are one point
+        self.resolution = resolution
+        # A point follows the last max_weight runs rather than all of them
+        self.max_weight = max_weight
+        self.frequencies = np.empty(0)
+        self.levels = np.empty(0)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.lock = threading.Lock()
+        self.modified = False
+
+    def __len__(self) -> int:
+        return len(self.frequencies)
+
+    def load(self) -> bool:
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        try:
+            with np.load(self.path) as table:
+                frequencies, levels, counts = table['frequencies'], table['levels'], table['counts']
+        except (OSError, KeyError, ValueError) as e:
+            print(f'Could not load calibration {self.path}: {e}')
+            return False
+        order = np.argsort(frequencies)
+        with self.lock:
+            self.frequencies = frequencies[order].astype(np.float64)
+            self.levels = levels[order].astype(np.float64)
+            self.counts = counts[order].astype(np.int64)
+            self.modified = False
+        return True
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            frequencies, levels, counts = self.frequencies.copy(), self.levels.copy(), self.counts.copy()
+            self.modified = False
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Written aside and moved into place so a crash never leaves half a table
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'wb') as file:
+            np.savez(file, frequencies=frequencies, levels=levels, counts=counts)
+        os.replace(temporary, self.path)
+
+    def clear(self):
+        with self.lock:
+            self.frequencies = np.empty(0)
+            self.levels = np.empty(0)
+            self.counts = np.empty(0, dtype=np.int64)
+            self.modified = True
+
+    def seed(self, frequencies, levels):
+        # Replaces the table, e.g. with the result of an open loop scan
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        levels = np.asarray(levels, dtype=np.float64)
+        valid = np.isfinite(frequencies) & np.isfinite(levels) & (frequencies > 0.0)
+        frequencies, levels = frequencies[valid], levels[valid]
+        order = np.argsort(frequencies)
+        with self.lock:
+            self.frequencies = frequencies[order]
+            self.levels = levels[order]
+            self.counts = np.ones(len(order), dtype=np.int64)
+            self.modified = True
+
+    def predict(self, frequencies, field: float) -> np.ndarray:
+        # dBm for field V/m at each frequency in Hz, None with an empty table
+        with self.lock:
+            table, levels = self.frequencies, self.levels
+        if len(table) == 0 or field <= 0.0:
+            return None
+        return np.interp(np.log(frequencies), np.log(table), levels) + 20.0 * np.log10(field)
+
+    def predictOne(self, frequency: float, field: float) -> float:
+        power = self.predict(np.asarray(frequency, dtype=np.float64), field)
+        return float(power) if power is not None else None
+
+    def record(self, frequency: float, power: float, field: float):
+        # A settled operating point, power dBm gave field V/m at frequency Hz
+        if frequency <= 0.0 or field <= 0.0:
+            return
+        level = power - 20.0 * np.log10(field)
+        with self.lock:
+            index = int(np.searchsorted(self.frequencies, frequency))
+            for neighbour in (index - 1, index):
+                if 0 <= neighbour < len(self.frequencies) and abs(self.frequencies[neighbour] - frequency) <= self.resolution * frequency:
+                    count = min(self.counts[neighbour] + 1, self.max_weight)
+                    self.levels[neighbour] += (level - self.levels[neighbour]) / count
+                    self.counts[neighbour] = count
+                    break
+            else:
+                self.frequencies = np.insert(self.frequencies, index, frequency)
+                self.levels = np.insert(self.levels, index, level)
+                self.counts = np.insert(self.counts, index, 1)
+            self.modified = True
+
+
+class TransferStore():
+    # Open loop transfer functions from characterisation scans, one .npy of TRANSFER_DTYPE per
+    # amplifier and antenna pair. Loading maps the file rather than reading it.
+
+    def __init__(self, directory: str = 'Calibrations'):
+        self.directory = directory
+
+    def path(self, amplifier: str, antenna: str, extension: str = '.npy') -> str:
+        return os.path.join(self.directory, equipmentKey(amplifier, antenna) + extension)
+
+    def save(self, amplifier: str, antenna: str, frequencies, transfer) -> str:
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        transfer = np.asarray(transfer, dtype=np.float64)
+        valid = np.isfinite(frequencies) & np.isfinite(transfer)
+        table = np.empty(int(valid.sum()), dtype=TRANSFER_DTYPE)
+        table['frequency'] = frequencies[valid]
+        table['transfer'] = transfer[valid]
+        table.sort(order='frequency')
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(amplifier, antenna)
+        temporary = f'{path}.tmp'
+        with open(temporary, 'wb') as file:
+            np.save(file, table)
+        os.replace(temporary, path)
+        return path
+
+    def load(self, amplifier: str, antenna: str) -> np.ndarray:
+        # Read-only memory map of the scan, None if the pair was never scanned
+        path = self.path(amplifier, antenna)
+        if not os.path.exists(path):
+            return None
+        try:
+            table = np.load(path, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            print(f'Could not load transfer function {path}: {e}')
+            return None
+        if table.dtype != TRANSFER_DTYPE:
+            print(f'Unexpected transfer function format in {path}')
+            return None
+        return table
@@ -0,0 +1,80 @@
+import itertools
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+
+class CoalescingQueue():
+
+    def __init__(self, coalesce: set = None):
+        # Keys in coalesce are last-writer-wins, everything else is plain FIFO
+        self.coalesce = set(coalesce) if coalesce is not None else set()
+        self.entries = OrderedDict()
+        self.tokens = itertools.count()
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.peak_depth = 0
+
+    def put(self, command: tuple):
+        key = command[0]
+        enqueued = time.perf_counter()
+        with self.condition:
+            if key in self.coalesce:
+                if key in self.entries:
+                    # Replace the stale write and move it behind everything queued since
+                    del self.entries[key]
+                    self.dropped += 1
+                self.entries[key] = (command, enqueued)
+            else:
+                self.entries[next(self.tokens)] = (command, enqueued)
+            self.peak_depth = max(self.peak_depth, len(self.entries))
+            self.condition.notify()
+
+    def get(self, block: bool = True, timeout: float = None) -> tuple:
+        return self.getTimed(block, timeout)[0]
+
+    def getTimed(self, block: bool = True, timeout: float = None) -> tuple:
+        # Returns (command, perf_counter time it was queued)
+        with self.condition:
+            if block:
+                if not self.condition.wait_for(lambda: len(self.entries) > 0, timeout):
+                    raise queue.Empty
+            elif len(self.entries) == 0:
+                raise queue.Empty
+            entry = self.entries.popitem(last=False)[1]
+            if len(self.entries) == 0:
+                self.condition.notify_all()
+            return entry
+
+    def qsize(self) -> int:
+        with self.condition:
+            return len(self.entries)
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def clear(self) -> int:
+        with self.condition:
+            cleared = len(self.entries)
+            self.entries.clear()
+            self.condition.notify_all()
+            return cleared
+
+    def discard(self, key) -> int:
+        # Removes every queued command with this key
+        with self.condition:
+            stale = [token for token, entry in self.entries.items() if entry[0][0] == key]
+            for token in stale:
+                del self.entries[token]
+            return len(stale)
+
+    def join(self):
+        # Blocks until the consumer has taken everything that was queued
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.entries) == 0)
+
+    def resetCounters(self):
+        with self.condition:
+            self.dropped = 0
+            self.peak_depth = len(self.entries)
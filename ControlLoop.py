@@ -0,0 +1,205 @@
+import threading
+import time
+from PyQt5.QtCore import QObject, pyqtSignal
+from LatencyStats import LatencyHistogram
+from SampleBuffer import SampleRingBuffer, COMPOSITE, TIME
+from SampleFilter import SampleStream
+from Calibration import FieldCalibration
+from GainSchedule import GainSchedule
+
+
+class FieldControlLoop(QObject):
+    # Closed loop field leveling on its own thread. The probe thread wakes it through onSample()
+    # with a direct connection, every wakeup runs the PID on all samples that arrived since the
+    # last one and queues the new power with the signal generator. Nothing here waits on the GUI,
+    # which only sees the loop through the throttled signals below.
+    #
+    # With a FieldCalibration, each new frequency starts from the power the table predicts for the
+    # target field so the PID only trims the residual, and the power the loop settles on at the
+    # old frequency goes back into the table.
+    #
+    # With a GainSchedule, every step looks up the gains for the current frequency and target
+    # and switches to them bumplessly, falling back to default_gains outside the schedule.
+    # setDefaultGains() is the only way to change gains while the loop runs.
+    powerCommanded = pyqtSignal(float)
+    # True while the PID asks for more than the amplifier may be driven with
+    powerLimited = pyqtSignal(bool)
+    loopStats = pyqtSignal(dict)
+
+    def __init__(self, samples: SampleRingBuffer, signal_generator, pid_controller, equipment_limits, stages: list = (), calibration: FieldCalibration = None, gain_schedule: GainSchedule = None):
+        super().__init__()
+        self.stream = SampleStream(samples, stages)
+        self.signal_generator = signal_generator
+        self.pid_controller = pid_controller
+        self.equipment_limits = equipment_limits
+        self.calibration = calibration
+        self.gain_schedule = gain_schedule
+        # Gains outside the schedule, taken from the controller at start()
+        self.default_gains = None
+        self.gains = None
+        self.gain_switches = 0
+        # Hz, set from the signal generator's frequencySet
+        self.frequency = None
+        self.pending_frequency = None
+        # Within this fraction of the target for settle_steps steps in a row counts as settled
+        self.settle_tolerance = 0.05
+        self.settle_steps = 8
+        self.settled_count = 0
+        self.seeded = 0
+        self.min_power = -110.0
+        self.output_power = -10.0
+        self.power_limited = False
+        # Wakes the loop every so often with no samples so it notices stop
+        self.sample_timeout = 0.25
+        self.display_interval = 0.1
+        self.stats_interval = 1.0
+        self.sample_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.control_thread = None
+        self.resetStats()
+
+    def resetStats(self):
+        # period: time between PID steps, latency: newest sample to setPower queued
+        self.periods = LatencyHistogram()
+        self.latencies = LatencyHistogram()
+        self.period_sum = 0.0
+        self.period_squares = 0.0
+        self.steps = 0
+        self.last_step = None
+
+    def setFrequency(self, frequency: float):
+        # Connected directly to frequencySet, the loop thread picks it up on its next wakeup
+        self.pending_frequency = frequency
+        self.sample_event.set()
+
+    def setDefaultGains(self, Kp: float, Ki: float, Kd: float):
+        self.default_gains = (Kp, Ki, Kd)
+
+    def onSample(self, x: float, y: float, z: float, composite: float):
+        # Runs on the probe thread, keep it to setting the event
+        self.sample_event.set()
+
+    def start(self, output_power: float):
+        self.stop()
+        self.output_power = output_power
+        self.power_limited = False
+        self.settled_count = 0
+        self.stream.reset()
+        self.pid_controller.reset(output_power)
+        if self.default_gains is None:
+            self.default_gains = (self.pid_controller.Kp, self.pid_controller.Ki, self.pid_controller.Kd)
+        self.gains = None
+        self.resetStats()
+        self.stop_event.clear()
+        self.sample_event.clear()
+        self.control_thread = threading.Thread(target=self.run, daemon=True)
+        self.control_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.sample_event.set()
+        if self.control_thread is not None and self.control_thread.is_alive():
+            self.control_thread.join()
+        self.control_thread = None
+
+    def isRunning(self) -> bool:
+        return self.control_thread is not None and self.control_thread.is_alive()
+
+    def run(self):
+        last_display = 0.0
+        last_stats = time.perf_counter()
+        while not self.stop_event.is_set():
+            if not self.sample_event.wait(self.sample_timeout):
+                continue
+            self.sample_event.clear()
+            if self.stop_event.is_set():
+                break
+            if self.pending_frequency is not None:
+                frequency, self.pending_frequency = self.pending_frequency, None
+                self.changeFrequency(frequency)
+            block = self.stream.update()
+            if len(block) == 0:
+                continue
+            self.step(block[-1])
+            now = time.perf_counter()
+            if now - last_display >= self.display_interval:
+                self.powerCommanded.emit(self.output_power)
+                last_display = now
+            if now - last_stats >= self.stats_interval:
+                self.loopStats.emit(self.summary())
+                last_stats = now
+        # The PID belongs to this thread until here, nothing else may touch it mid calculate()
+        self.pid_controller.clear()
+        # Where the loop left the power, the throttle may have skipped it
+        self.powerCommanded.emit(self.output_power)
+
+    def changeFrequency(self, frequency: float):
+        if frequency == self.frequency:
+            return
+        if self.calibration is not None and self.frequency is not None and self.settled_count >= self.settle_steps:
+            self.calibration.record(self.frequency, self.output_power, self.pid_controller.current_field)
+        self.frequency = frequency
+        self.settled_count = 0
+        if self.calibration is None:
+            return
+        power = self.calibration.predictOne(frequency, self.pid_controller.getTargetValue())
+        if power is None:
+            return
+        power = min(max(power, self.min_power), self.equipment_limits.max_power)
+        # Samples still in the stream were taken at the old frequency
+        self.stream.reset()
+        self.pid_controller.reset(power)
+        self.output_power = power
+        self.signal_generator.setPower(power)
+        self.seeded += 1
+
+    def step(self, sample):
+        # The amplifier can be changed while the loop runs
+        self.pid_controller.setOutputLimits(self.min_power, self.equipment_limits.max_power)
+        # New default gains from the GUI are picked up here too, schedule or not
+        gains = None
+        if self.gain_schedule is not None and self.frequency is not None:
+            gains = self.gain_schedule.lookup(self.frequency, self.pid_controller.getTargetValue())
+        if gains is None:
+            gains = self.default_gains
+        if gains is not self.gains:
+            self.pid_controller.switchGains(*gains)
+            self.gains = gains
+            self.gain_switches += 1
+        output_power = self.pid_controller.calculate(sample[COMPOSITE], sample[TIME])
+        limited = self.pid_controller.saturation > 0 and output_power >= self.equipment_limits.max_power
+        self.output_power = output_power
+        self.signal_generator.setPower(output_power)
+        now = time.perf_counter()
+        self.latencies.record(now - sample[TIME])
+        if self.last_step is not None:
+            period = now - self.last_step
+            self.periods.record(period)
+            self.period_sum += period
+            self.period_squares += period * period
+            self.steps += 1
+        self.last_step = now
+        target = self.pid_controller.getTargetValue()
+        if abs(sample[COMPOSITE] - target) <= self.settle_tolerance * target:
+            self.settled_count += 1
+        else:
+            self.settled_count = 0
+        if limited != self.power_limited:
+            self.power_limited = limited
+            self.powerLimited.emit(limited)
+
+    def summary(self) -> dict:
+        mean = self.period_sum / self.steps if self.steps > 0 else 0.0
+        variance = self.period_squares / self.steps - mean * mean if self.steps > 0 else 0.0
+        return {
+            'steps': self.steps,
+            'period_mean': mean,
+            'period_p50': self.periods.percentile(50.0),
+            'period_p99': self.periods.percentile(99.0),
+            'period_max': self.periods.percentile(100.0),
+            'jitter': max(variance, 0.0) ** 0.5,
+            'latency_p50': self.latencies.percentile(50.0),
+            'latency_p99': self.latencies.percentile(99.0),
+            'seeded': self.seeded,
+            'gain_switches': self.gain_switches,
+        }
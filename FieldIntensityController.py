@@ -16,14 +16,21 @@ from qt_material import apply_stylesheet
 from MainWindow import Ui_MainWindow
 from SignalGenerator import AgilentN5181A, Time, Modulation, Frequency, SignalGenerator
 from FieldProbe import ETSLindgrenHI6006, FieldProbe
+from ProbeManager import ProbeManager, Aggregate
 from LivePlot import FrequencyPlot, PowerPlot
 from PID import PIDController
+from SampleBuffer import COMPOSITE, X, Y, Z
+from SampleFilter import SampleStream, OutlierRejection, MovingAverage, Decimate
 from EquipmentLimits import EquipmentLimits
+from ControlLoop import FieldControlLoop
+from Calibration import FieldCalibration, TransferStore
+from GainSchedule import GainSchedule
 
 import os
 import sys
 import math
 import time
+import numpy as np
 
 import signal
 from PyQt5.QtCore import QResource
@@ -45,18 +52,21 @@ class PIDGainsPopUp(QDialog):
         self.setWindowTitle('PID Gains')
         
         layout = QVBoxLayout()
+        # The dialog edits the default gains, the controller may be on scheduled ones
+        pid_controller = self.main_window.pid_controller
+        Kp, Ki, Kd = self.main_window.control_loop.default_gains or (pid_controller.Kp, pid_controller.Ki, pid_controller.Kd)
 
         self.spinbox_Kp = QDoubleSpinBox()
         self.label_Kp = QLabel("Proportional Gain")
-        self.spinbox_Kp.setValue(self.main_window.pid_controller.Kp)
+        self.spinbox_Kp.setValue(Kp)
 
         self.spinbox_Ki = QDoubleSpinBox()
-        self.label_Ki = QLabel("Integral Gain")
-        self.spinbox_Ki.setValue(self.main_window.pid_controller.Ki)
+        self.label_Ki = QLabel("Integral Gain (per second)")
+        self.spinbox_Ki.setValue(Ki)
 
         self.spinbox_Kd = QDoubleSpinBox()
-        self.label_Kd = QLabel("Derivative Gain")
-        self.spinbox_Kd.setValue(self.main_window.pid_controller.Kd)
+        self.label_Kd = QLabel("Derivative Gain (seconds)")
+        self.spinbox_Kd.setValue(Kd)
 
         layout.addWidget(self.label_Kp)
         layout.addWidget(self.spinbox_Kp)
@@ -77,8 +87,12 @@ class PIDGainsPopUp(QDialog):
         self.setLayout(layout)
         
     def save_values(self):
-        # Save the values of the spin boxes to the main window's PID controller gains
-        self.main_window.pid_controller.setGains(self.spinbox_Kp.value(), self.spinbox_Ki.value(), self.spinbox_Kd.value())
+        # Used wherever the gain schedule has no entry. A running loop switches to them bumplessly
+        # on its own thread, touching the controller from here would kick the output.
+        control_loop = self.main_window.control_loop
+        control_loop.setDefaultGains(self.spinbox_Kp.value(), self.spinbox_Ki.value(), self.spinbox_Kd.value())
+        if not control_loop.isRunning():
+            self.main_window.pid_controller.setGains(self.spinbox_Kp.value(), self.spinbox_Ki.value(), self.spinbox_Kd.value())
 
         # Close the dialog
         self.accept()
@@ -91,13 +105,19 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.setWindowTitle('XtraByte Field Controller')
         
         # Field Probe Signal -> Slot Connections
-        self.field_probe = ETSLindgrenHI6006()
-        self.field_probe.fieldIntensityReceived.connect(self.on_fieldProbe_fieldIntensityReceived)
+        # One HI-6006 per port, the control loop regulates on the selected aggregate of all of them
+        self.field_probe = ProbeManager(['COM5'])
         self.field_probe.identityReceived.connect(self.on_fieldProbe_identityReceived)
         self.field_probe.batteryReceived.connect(self.on_fieldProbe_batteryReceived)
         self.field_probe.temperatureReceived.connect(self.on_fieldProbe_temperatureReceived)
         self.field_probe.serialConnectionError.connect(self.on_fieldProbe_serialConnectionError)
         self.field_probe.fieldProbeError.connect(self.on_fieldProbe_fieldProbeError)
+        self.field_probe.connectionLost.connect(self.on_fieldProbe_connectionLost)
+        self.field_probe.probeReconnected.connect(self.on_fieldProbe_probeReconnected)
+        # The display reads a heavier average at a fraction of the rate on a timer, the GUI never
+        # sees individual samples
+        self.display_stream = SampleStream(self.field_probe.samples, [OutlierRejection(7, 3.0), MovingAverage(16), Decimate(8)])
+        self.display_interval = 0.1
         
         # Signal Generator Signal -> Slot Connections
         self.signal_generator = AgilentN5181A()
@@ -113,23 +133,25 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.signal_generator.modFreqSet.connect(self.on_sigGen_modFrequencySet)
         self.signal_generator.amTypeSet.connect(self.on_sigGen_amTypeSet)
         self.signal_generator.modDepthSet.connect(self.on_sigGen_modDepthSet)
+        self.signal_generator.configurationApplied.connect(self.on_sigGen_configurationApplied)
         
         # Initialize State
         self.sweep_in_progress = False
+        self.scanning = False
+        # (amplifier, antenna) the running characterisation scan belongs to
+        self.scan_equipment = None
+        # Fixed power for open loop characterisation scans
+        self.reference_power = -20.0
         self.output_on = False
         self.modulation_on = False
-        self.measured_field_strength = 0.0
         self.target_field_strength = 1.0
-        self.x_field = 0.0
-        self.y_field = 0.0
-        self.z_field = 0.0
         self.output_power = -10.0
         self.output_frequency = 100.0
         self.antenna_gain = 10.0
         self.distance = 0.1
         self.equipment_limits = EquipmentLimits(0.1, 0.1, 6000.0, 6000.0, 15.0)
         self.sweep_start_time = time.time()
-        self.power_start_time = time.time()
+        self.power_start_time = time.perf_counter()
         
         
         ### UI Input and Control Signal -> Slot Connections
@@ -158,6 +180,12 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.doubleSpinBox_sweepTerm.setStyleSheet('QDoubleSpinBox { color: white; }')
         self.pushButton_startSweep.pressed.connect(self.on_pushButton_startSweep_pressed)
         self.pushButton_pauseSweep.pressed.connect(self.on_pushButton_pauseSweep_pressed)
+        self.pushButton_characterise = QPushButton('Characterise', self.gridLayoutWidget)
+        self.pushButton_characterise.setMinimumSize(QtCore.QSize(216, 40))
+        self.pushButton_characterise.setMaximumSize(QtCore.QSize(216, 40))
+        self.gridLayout_8.addWidget(self.pushButton_characterise, 4, 1, 1, 1)
+        self.pushButton_characterise.pressed.connect(self.on_pushButton_characterise_pressed)
+        self.signal_generator.characterisationFinished.connect(self.on_sigGen_characterisationFinished)
         
         # Output Modulation Control
         self.spinBox_modDepth.valueChanged[float].connect(self.spinBox_modDepth_valueChanged)
@@ -174,7 +202,30 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.comboBox_antenna.setStyleSheet('QComboBox { color: white; }')
         
         # Closed-Loop Power Control
-        self.pid_controller = PIDController(0.6, 0.0, 0.3) # Good @ 4 V/m with horn
+        # Same response as the per-sample 0.6 / 0.0 / 0.3 incremental tuning at the ~33 samples/s
+        # of a 9600 baud probe, which was good @ 4 V/m with horn
+        self.pid_controller = PIDController(0.3, 20.0, 0.0)
+        self.pid_controller.setSlewRate(20.0)
+        # Runs on its own thread, woken straight from the probe thread, and gets every sample
+        # spike-free and lightly smoothed
+        # Power per V/m for the selected amplifier and antenna, from a characterisation scan and
+        # refined by previous sweeps, seeds the loop at every new frequency
+        self.transfer_store = TransferStore(os.path.join(CURRENT_DIR, 'Calibrations'))
+        self.calibration = FieldCalibration(None)
+        # Gains per amplifier, antenna, band and target where the defaults above don't hold
+        self.gain_schedule = GainSchedule()
+        gain_schedule_path = os.path.join(CURRENT_DIR, 'gain_schedule.csv')
+        if os.path.exists(gain_schedule_path):
+            try:
+                print(f'Loaded {self.gain_schedule.load(gain_schedule_path)} gain schedule entries')
+            except (OSError, KeyError, ValueError) as e:
+                print(f'Could not load gain schedule {gain_schedule_path}: {e}')
+        self.control_loop = FieldControlLoop(self.field_probe.samples, self.signal_generator, self.pid_controller, self.equipment_limits, [OutlierRejection(7, 3.0), MovingAverage(4)], self.calibration, self.gain_schedule)
+        self.signal_generator.frequencySet.connect(self.control_loop.setFrequency, Qt.DirectConnection)
+        self.field_probe.fieldIntensityReceived.connect(self.control_loop.onSample, Qt.DirectConnection)
+        self.control_loop.powerCommanded.connect(self.on_controlLoop_powerCommanded)
+        self.control_loop.powerLimited.connect(self.on_controlLoop_powerLimited)
+        self.control_loop.loopStats.connect(self.on_controlLoop_loopStats)
         
         # Initiate Plots
         self.sweep_plot_widget = QWidget(self)
@@ -191,6 +242,10 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         
         self.field_timer = QTimer(self)
         self.field_timer.timeout.connect(self.update_field_data_plot)
+        
+        self.display_timer = QTimer(self)
+        self.display_timer.timeout.connect(self.update_field_strength_display)
+        self.display_timer.start(int(self.display_interval * 1000))
 
         self.doubleSpinBox_sweepTerm.setValue(0.01)
         self.spinBox_startFreq.setValue(100.0)
@@ -255,6 +310,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.pushButton_startSweep.setEnabled(False)
             self.pushButton_rfOn.setEnabled(False)
             return
+        self.selectEquipment()
         self.applyFrequencyLimits(self.spinBox_startFreq.value(), self.spinBox_stopFreq.value())
         
             
@@ -279,6 +335,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.pushButton_startSweep.setEnabled(False)
             self.pushButton_rfOn.setEnabled(False)
             return
+        self.selectEquipment()
         self.applyFrequencyLimits(self.spinBox_startFreq.value(), self.spinBox_stopFreq.value())
                 
     def on_spinBox_targetStrength_valueChanged(self, target):
@@ -304,6 +361,10 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.spinBox_stopFreq.setEnabled(enabled)
         self.spinBox_dwell.setEnabled(enabled)
         self.pushButton_startSweep.setEnabled(enabled)
+        self.pushButton_characterise.setEnabled(enabled)
+        # Changing equipment mid sweep would file the results under the wrong pair
+        self.comboBox_amplifier.setEnabled(enabled)
+        self.comboBox_antenna.setEnabled(enabled)
         self.pushButton_pauseSweep.setEnabled(not enabled)
         self.progressBar_freqSweep.setHidden(enabled)
         
@@ -372,19 +433,80 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.toggleSweepUI(enabled=False)
         self.signal_generator.startFrequencySweep()
         
+    def on_pushButton_characterise_pressed(self):
+        if not self.equipmentSelected() or not self.pushButton_startSweep.isEnabled():
+            self.displayAlert('Select a valid amplifier, antenna and frequency range before characterising.')
+            return
+        # Open loop, the control loop stays off while RF is on
+        self.scanning = True
+        self.scan_equipment = (self.comboBox_amplifier.currentText(), self.comboBox_antenna.currentText())
+        self.sweep_plot.clear_plot()
+        self.sweep_start_time = time.time()
+        self.sweep_in_progress = True
+        self.signal_generator.setRFOut(True)
+        self.sweep_timer.start(100)
+        self.toggleSweepUI(enabled=False)
+        self.signal_generator.startCharacterisationScan(self.field_probe.samples, min(self.reference_power, self.equipment_limits.max_power))
+    
+    def on_sigGen_characterisationFinished(self, frequencies, transfer):
+        amplifier, antenna = self.scan_equipment
+        # A scan the probe barely saw would wipe out the tables this pair already has, so it has
+        # to measure at least two points reaching to within a step of either end of the sweep
+        measured = np.sort(frequencies[np.isfinite(transfer)])
+        steps = np.sort(frequencies)
+        if len(measured) < 2 or measured[0] > steps[1] or measured[-1] < steps[-2]:
+            self.complete_sweep()
+            self.displayAlert(f'Characterisation of {amplifier} with {antenna} got field readings at {len(measured)} of {len(steps)} frequencies, the existing calibration is kept.')
+            return
+        path = self.transfer_store.save(amplifier, antenna, frequencies, transfer)
+        print(f'Characterisation of {amplifier} with {antenna} saved to {path}')
+        # The scan replaces whatever earlier sweeps had learned for this pair
+        self.calibration.seed(frequencies, -transfer)
+        self.complete_sweep()
+    
+    def equipmentSelected(self) -> bool:
+        # Calibrations are filed by amplifier and antenna, neither may be the placeholder
+        return '--Please Select--' not in (self.comboBox_amplifier.currentText(), self.comboBox_antenna.currentText())
+    
+    def selectEquipment(self):
+        amplifier, antenna = self.comboBox_amplifier.currentText(), self.comboBox_antenna.currentText()
+        self.gain_schedule.select(amplifier, antenna)
+        # Learned table for the selected pair if there is one, else its characterisation scan
+        if self.calibration.modified:
+            self.calibration.save()
+        if not self.equipmentSelected():
+            # Half a pair, learn in memory only
+            self.calibration.path = None
+            self.calibration.clear()
+            self.calibration.modified = False
+            return
+        self.calibration.path = self.transfer_store.path(amplifier, antenna, '.npz')
+        if self.calibration.load():
+            return
+        transfer = self.transfer_store.load(amplifier, antenna)
+        if transfer is not None:
+            self.calibration.seed(transfer['frequency'], -transfer['transfer'])
+            self.calibration.modified = False
+        else:
+            self.calibration.clear()
+            self.calibration.modified = False
+            
     def on_pushButton_pauseSweep_pressed(self):
         self.complete_sweep()
     
     def complete_sweep(self):    
         self.sweep_in_progress = False
+        self.scanning = False
         self.sweep_timer.stop()
         self.signal_generator.setRFOut(False)
         self.signal_generator.stopFrequencySweep()
-        self.pid_controller.clear()
+        if self.calibration.modified:
+            self.calibration.save()
         self.toggleSweepUI(enabled=True)
                 
     def spinBox_modDepth_valueChanged(self, percent: float):
-        self.signal_generator.setAMLinearDepth(float(percent))
+        with self.signal_generator.transaction():
+            self.signal_generator.setAMLinearDepth(float(percent))
     
     def applyModFrequencyUnits(self, freq: float, unit: str) -> (float, str):
         if unit == Frequency.Hz.value:
@@ -420,12 +542,18 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.label_validSettings.setText('Valid Settings')
         self.label_validSettings.setStyleSheet('color: green')
         self.pushButton_modulationOn.setEnabled(True)
-        self.signal_generator.setAMFrequency(freq)
+        with self.signal_generator.transaction():
+            self.signal_generator.setAMFrequency(freq)
         
     def pushButton_modulationState_pressed(self):
         sender = self.sender()
         on = sender == self.pushButton_modulationOn
-        self.signal_generator.setModulationState(on)
+        # Depth and rate go out with the state so modulation never starts on stale settings
+        with self.signal_generator.transaction():
+            if on:
+                self.signal_generator.setAMLinearDepth(float(self.spinBox_modDepth.value()))
+                self.signal_generator.setAMFrequency(self.spinBox_modFreq.value())
+            self.signal_generator.setModulationState(on)
         
     def displayAlert(self, text):
         self.alert = QMessageBox()
@@ -440,25 +568,26 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.label_fieldProbe.setPixmap(scaledPixmap)
         self.label_fieldProbeName.setText('ETS Lindgren ' + model + ' Serial: ' + serial)
 
-    @pyqtSlot(float, float, float, float)
-    def on_fieldProbe_fieldIntensityReceived(self, x: float, y: float, z: float, composite: float):
-        self.measured_field_strength = composite
-        self.updateFieldStrengthUI(x, y, z, composite)
-        if self.output_on:
-            pid_out = self.pid_controller.calculate(composite)
-            print("PID Out: " + str(pid_out))
-            #output_power = self.calculatePowerOut(pid_out)
-            output_power = self.output_power + pid_out
-            if output_power > self.equipment_limits.max_power:
-                output_power = self.equipment_limits.max_power
-                self.label_validSettings.setText('Attempted Invalid Power Setting')
-                self.label_validSettings.setStyleSheet('color: red')
-            else:
-                self.label_validSettings.setText('Valid Settings')
-                self.label_validSettings.setStyleSheet('color: green')
-            if output_power < -110:
-                output_power = -110
-            self.signal_generator.setPower(output_power)
+    def update_field_strength_display(self):
+        if len(self.display_stream.update()) == 0:
+            return
+        latest = self.display_stream.latest()
+        self.updateFieldStrengthUI(latest[X], latest[Y], latest[Z], latest[COMPOSITE])
+    
+    def on_controlLoop_powerCommanded(self, power: float):
+        self.output_power = power
+        self.lcdNumber_powerOut.display(power)
+    
+    def on_controlLoop_powerLimited(self, limited: bool):
+        if limited:
+            self.label_validSettings.setText('Attempted Invalid Power Setting')
+            self.label_validSettings.setStyleSheet('color: red')
+        else:
+            self.label_validSettings.setText('Valid Settings')
+            self.label_validSettings.setStyleSheet('color: green')
+    
+    def on_controlLoop_loopStats(self, stats: dict):
+        print(f"Control loop: {stats['steps']} steps, period p50 {stats['period_p50'] * 1000:.2f} ms p99 {stats['period_p99'] * 1000:.2f} ms, jitter {stats['jitter'] * 1000:.2f} ms, latency p99 {stats['latency_p99'] * 1000:.2f} ms")
             
     def calculatePowerOut(self, pid_out: float) -> float:
         power_watts = (math.pow(pid_out, 2) * math.pow(self.distance, 2)) / (30.0 * self.antenna_gain)
@@ -473,13 +602,11 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.lcdNumber_xMag.display(x)
         self.lcdNumber_yMag.display(y)
         self.lcdNumber_zMag.display(z)
-        self.measured_field_strength = composite
-        self.x_field = x
-        self.y_field = y
-        self.z_field = z
         
     def update_field_data_plot(self):
-        self.field_plot.update_plot(time.time() - self.power_start_time, setpoint = self.pid_controller.getTargetValue(), composite=self.measured_field_strength, x=self.x_field, y=self.y_field, z=self.z_field)
+        self.display_stream.update()
+        samples = self.display_stream.output.after(self.power_start_time)
+        self.field_plot.update_plot(samples, self.power_start_time, time.perf_counter() - self.power_start_time, setpoint=self.pid_controller.getTargetValue())
     
     def on_fieldProbe_batteryReceived(self, level: int):
         self.label_chargeLevel.setText(f'{str(level)} %')
@@ -493,11 +620,18 @@ class MainWindow(QMainWindow, Ui_MainWindow):
     def on_fieldProbe_serialConnectionError(self, message: str):
         self.displayAlert("Probe Connection:" + message)
     
+    def on_fieldProbe_connectionLost(self, message: str):
+        # The probe thread reconnects on its own, only a failure to come back raises an alert
+        print(f'Probe connection lost: {message}')
+    
+    def on_fieldProbe_probeReconnected(self, reconnect_time: float, downtime: float):
+        print(f'Probe reconnected in {reconnect_time * 1000:.1f} ms, down for {downtime * 1000:.1f} ms')
+    
     def on_sigGen_rfOutSet(self, on: bool):
         if on:
             self.field_plot.clear_plot()
             pixmap = QPixmap('broadcast-on.png')
-            self.power_start_time = time.time()
+            self.power_start_time = time.perf_counter()
             self.field_timer.start(10)  # Update every 100 ms
         else:
             pixmap = QPixmap('broadcast-off.png')
@@ -505,9 +639,14 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         scaledPixmap = pixmap.scaled(64, 64, QtCore.Qt.KeepAspectRatio, QtCore.Qt.FastTransformation)
         self.label_rfOutState.setPixmap(scaledPixmap)
         self.output_on = on
+        # Housekeeping queries back off while the field is being regulated
+        self.field_probe.setRegulating(on)
+        if on and not self.scanning:
+            self.control_loop.start(self.output_power)
+        else:
+            self.control_loop.stop()
         self.pushButton_rfOn.setEnabled(not on)
         self.pushButton_rfOff.setEnabled(on)
-        self.pid_controller.clear()
     
     def on_sigGen_instrumentDetected(self, detected: bool):
         if detected:
@@ -529,13 +668,31 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         pixmap = QPixmap('AgilentN5181A.png')
         scaledPixmap = pixmap.scaled(275, 128, QtCore.Qt.KeepAspectRatio, QtCore.Qt.FastTransformation)
         self.label_sigGen.setPixmap(scaledPixmap)
-        # Initialize sig gen to match UI
-        self.signal_generator.setRFOut(False)
-        self.signal_generator.setModulationState(False)
+        # Initialize sig gen to match UI, in one message and one readback
         self.signal_generator.setStartFrequency(100.0)
         self.signal_generator.setStopFrequency(1000.0)
-        self.signal_generator.setFrequency(100.0, Frequency.MHz.value)
-        self.signal_generator.setPower(-10.0)
+        with self.signal_generator.transaction():
+            self.signal_generator.setRFOut(False)
+            self.signal_generator.setModulationState(False)
+            self.signal_generator.setFrequency(100.0, Frequency.MHz.value)
+            self.signal_generator.setPower(-10.0)
+        
+    def on_sigGen_configurationApplied(self, applied: dict):
+        # One readback for a whole transaction, keyed by SCPI name, fanned out to the same
+        # updates the per-setting signals drive
+        if 'RFOut' in applied:
+            self.on_sigGen_rfOutSet(bool(int(applied['RFOut'])))
+        if 'Frequency' in applied:
+            self.control_loop.setFrequency(float(applied['Frequency']))
+            self.on_sigGen_frequencySet(float(applied['Frequency']))
+        if 'Power' in applied:
+            self.on_sigGen_powerSet(float(applied['Power']))
+        if 'ModulationState' in applied:
+            self.on_sigGen_modStateSet(bool(int(applied['ModulationState'])))
+        if 'AMLinDepth' in applied:
+            self.on_sigGen_modDepthSet(float(applied['AMLinDepth']))
+        if 'AMFreq' in applied:
+            self.on_sigGen_modFrequencySet(Modulation.AM.value, float(applied['AMFreq']))
         
     def on_sigGen_frequencySet(self, frequency: float):
         frequency /= 1000000.0
@@ -548,6 +705,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.sweep_plot.update_plot(time.time() - self.sweep_start_time, self.output_frequency)
     
     def on_sigGen_powerSet(self, power: float):
+        if self.control_loop.isRunning():
+            # Every loop step reads back a power, the display follows the throttled powerCommanded
+            return
         self.output_power = power
         self.lcdNumber_powerOut.display(power)
     
@@ -583,6 +743,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.displayAlert(message)
     
     def closeEvent(self, event):
+        self.control_loop.stop()
+        if self.calibration.modified:
+            self.calibration.save()
         self.field_probe.stop()
         self.signal_generator.stop()
         del self.field_probe
@@ -2,10 +2,12 @@ import time
 import serial
 from serial import SerialException, SerialTimeoutException, serialutil
 import threading
-import queue
 import random
+from collections import deque
 from abc import ABC, abstractmethod
 from PyQt5.QtCore import QObject, pyqtSignal
+from SampleBuffer import SampleRingBuffer
+from ProbeScheduler import ProbeScheduler, CommandClass
 
     
 class SerialCommand(ABC):
@@ -32,7 +34,7 @@ class SerialCommand(ABC):
         message = response.decode().strip().strip(':')
         if message.startswith('E'):
             self.signal = 6
-            return True, self.ERRORS[message[1]]
+            return True, self.ERRORS[int(message[1])] if message[1:2].isdigit() else self.ERRORS[0]
         if message.endswith('F'):
             self.signal = 6
             return True, self.ERRORS[9]
@@ -92,6 +94,21 @@ class CompositeDataCommand(SerialCommand):
         self.z = float(response_str[10:15])
         self.composite = float(response_str[15:20])
         return self.x, self.y, self.z, self.composite
+    
+    def parseBytes(self, response: bytes) -> bool:
+        # Fast path for a clean ':D' + 4 x 5 digit fields + 'N' + CR reply, read straight from the
+        # serial buffer at fixed offsets. Returns False for anything else so the caller can fall
+        # back to checkForError and parse for the error message.
+        if len(response) != 24 or response[1] != 0x44 or response[22] != 0x4E:
+            return False
+        try:
+            self.x = float(response[2:7])
+            self.y = float(response[7:12])
+            self.z = float(response[12:17])
+            self.composite = float(response[17:22])
+        except ValueError:
+            return False
+        return True
 
 class FieldProbe(QObject):
     fieldIntensityReceived = pyqtSignal(float, float, float, float)
@@ -100,6 +117,8 @@ class FieldProbe(QObject):
     temperatureReceived = pyqtSignal(float) 
     serialConnectionError = pyqtSignal(str)
     fieldProbeError = pyqtSignal(str)
+    connectionLost = pyqtSignal(str)
+    probeReconnected = pyqtSignal(float, float)
     
     def __init__(self):
         super().__init__()
@@ -108,6 +127,7 @@ class FieldProbe(QObject):
         self.battery_level = 100
         self.battery_fail = False
         self.info_interval = 2.0
+        self.samples = SampleRingBuffer()
         
     def start(self):
         self.is_running = True
@@ -126,8 +146,13 @@ class FieldProbe(QObject):
         self.temperatureReceived.emit(random.randrange(40, 110))
         
     def getFieldStrengthMeasurement(self):
-        self.fieldIntensityReceived.emit(random.randrange(-10, 5), random.randrange(-10, 5), random.randrange(-10, 5), random.randrange(-10, 5))
+        x, y, z, composite = random.randrange(-10, 5), random.randrange(-10, 5), random.randrange(-10, 5), random.randrange(-10, 5)
+        self.samples.append(time.perf_counter(), x, y, z, composite)
+        self.fieldIntensityReceived.emit(x, y, z, composite)
         
+    def setRegulating(self, regulating: bool):
+        pass
+    
     def readWriteProbe(self):
         pass
 
@@ -138,18 +163,53 @@ class ETSLindgrenHI6006(QObject):
     temperatureReceived = pyqtSignal(float) 
     serialConnectionError = pyqtSignal(str)
     fieldProbeError = pyqtSignal(str)
+    baudRateSelected = pyqtSignal(int)
+    sampleRateMeasured = pyqtSignal(float)
+    schedulerStats = pyqtSignal(dict)
+    connectionLost = pyqtSignal(str)
+    # Seconds to reopen the port and renegotiate, seconds from the failure to the probe answering again
+    probeReconnected = pyqtSignal(float, float)
     
-    def __init__(self, serial_port: str = 'COM5'):
+    def __init__(self, serial_port: str = 'COM5', baud_rates: tuple = (115200, 9600), sample_capacity: int = 65536):
         super().__init__()
         self.serial_port = serial_port
+        # Tried fastest first at connect, the laser models run at 115.2k, the rest at 9600
+        self.baud_rates = sorted(baud_rates, reverse=True)
+        self.baud_rate = self.baud_rates[-1]
+        self.sample_rate = 0.0
+        # Every field sample lands here, written only by the probe thread
+        self.samples = SampleRingBuffer(sample_capacity)
         self.serial = None
         self.is_running = False
         self.battery_level = 100
         self.battery_fail = False
-        self.command_queue = queue.Queue()
         self.info_interval = 2.0
+        # Minimum spacing between field requests, the serial line is the real limit
         self.data_interval = 0.0005
+        # The longest reply, the 34 character identity, takes 35 ms at 9600 baud
+        self.read_timeout = 0.25
         self.stop_probe_event = threading.Event()
+        self.probe_thread = None
+        self.field_command = CompositeDataCommand()
+        self.scheduler = ProbeScheduler(self.field_command, (BatteryCommand, TemperatureCommand), self.data_interval, self.info_interval)
+        # Requests on the wire ahead of the reply being read, 1 waits for each reply before the next request
+        self.pipeline_depth = 1
+        # Longer than any reply, replies are framed on CR
+        self.max_response_length = 64
+        self.read_buffer = bytearray()
+        # (command, CommandClass, time queued) written and not answered yet
+        self.in_flight = deque()
+        # Reopen attempts start this far apart and double up to max_reconnect_delay, a USB
+        # adapter that drops off the bus usually reenumerates within a few hundred ms
+        self.reconnect_delay = 0.01
+        self.max_reconnect_delay = 2.0
+        # Give up and report a connection error after this long without the port
+        self.max_downtime = 60.0
+        self.negotiated = False
+        self.lost_time = None
+        self.reconnect_start = 0.0
+        self.reconnect_attempts = 0
+        self.connection_stats = {'reconnects': 0, 'attempts': 0, 'last_reconnect': 0.0, 'last_downtime': 0.0, 'max_downtime': 0.0, 'total_downtime': 0.0}
     
     def commandToSignal(self, command: SerialCommand) -> pyqtSignal:
         if type(command) == IdentityCommand:
@@ -166,7 +226,12 @@ class ETSLindgrenHI6006(QObject):
     def start(self):
         self.is_running = True
         try:
-            self.serial = serial.Serial(self.serial_port, baudrate=9600, bytesize=serial.SEVENBITS, parity=serial.PARITY_ODD, stopbits=1, timeout=5)
+            self.openSerial(self.baud_rates[0])
+            self.stop_probe_event.clear()
+            self.scheduler.reset()
+            self.negotiated = False
+            self.lost_time = None
+            self.in_flight.clear()
             self.probe_thread = threading.Thread(target=self.readWriteProbe)
             self.probe_thread.start()
             self.initializeProbe()
@@ -193,72 +258,256 @@ class ETSLindgrenHI6006(QObject):
     def stop(self):
         self.is_running = False
         self.stop_probe_event.set()
-        if self.probe_thread.is_alive() and self.probe_thread is not None:
+        self.scheduler.wake()
+        try:
+            if self.serial and self.serial.is_open:
+                # Wake the probe thread out of a blocking read
+                self.serial.cancel_read()
+        except:
+            # The probe thread closed the port under us while reconnecting
+            pass
+        if self.probe_thread is not None and self.probe_thread.is_alive():
             self.probe_thread.join()
-        if self.serial and self.serial.is_open:
-            self.serial.close()
+        self.closeSerial()
         
     def initializeProbe(self):
-        self.command_queue.put(IdentityCommand())
+        self.scheduler.submit(IdentityCommand())
         
     def getBatteryPercentage(self):
-        self.command_queue.put(BatteryCommand())
+        self.scheduler.submit(BatteryCommand(), CommandClass.HOUSEKEEPING)
         
     def getTemperature(self):
-        self.command_queue.put(TemperatureCommand())
+        self.scheduler.submit(TemperatureCommand(), CommandClass.HOUSEKEEPING)
     
     def getFieldStrengthMeasurement(self):
-        self.command_queue.put(CompositeDataCommand())
+        self.scheduler.submit(CompositeDataCommand(), CommandClass.FIELD)
+    
+    def setRegulating(self, regulating: bool):
+        # While regulating, battery and temperature queries wait for gaps between field requests
+        self.scheduler.setRegulating(regulating)
+    
+    def setDataInterval(self, interval: float):
+        self.data_interval = interval
+        self.scheduler.data_interval = interval
+    
+    def getSchedulerStats(self) -> dict:
+        return self.scheduler.summary()
+    
+    def setPipelined(self, pipelined: bool, depth: int = 2):
+        # Pipelined keeps requests queued at the probe while the current reply is read, so the
+        # line never idles for the probe's turnaround. At 115.2k the turnaround is about as long
+        # as a reply and a depth of 3 is needed to fill the line, deeper risks a Buffer Full Error.
+        self.pipeline_depth = max(depth, 2) if pipelined else 1
+    
+    def getBaudRate(self) -> int:
+        return self.baud_rate
+    
+    def getSampleRate(self) -> float:
+        return self.sample_rate
+    
+    def negotiateBaudRate(self) -> int:
+        # At the wrong rate the probe sees garbage and answers with garbage or not at all, so
+        # the first rate that returns a well formed identity is the one the probe runs at.
+        # None if no rate did, the port is left at the slowest.
+        identity = IdentityCommand()
+        baud_rates = self.baud_rates
+        if self.negotiated:
+            # Coming back from a reconnect, the probe has almost certainly kept its rate
+            baud_rates = [self.baud_rate] + [rate for rate in self.baud_rates if rate != self.baud_rate]
+        for baud_rate in baud_rates:
+            if self.stop_probe_event.is_set():
+                break
+            if self.serial.baudrate != baud_rate:
+                self.serial.baudrate = baud_rate
+            self.serial.reset_input_buffer()
+            self.serial.write(identity.command)
+            response = self.serial.read(identity.blocksize)
+            if len(response) == identity.blocksize and response.startswith(b':I') and response.endswith(b'\r'):
+                self.baud_rate = baud_rate
+                self.negotiated = True
+                return baud_rate
+            # Let the tail of a misread reply arrive before switching rates
+            time.sleep(self.read_timeout)
+        self.baud_rate = self.baud_rates[-1]
+        if self.serial.baudrate != self.baud_rate:
+            self.serial.baudrate = self.baud_rate
+        self.serial.reset_input_buffer()
+        self.fieldProbeError.emit(f'Probe did not answer at {", ".join(str(rate) for rate in self.baud_rates)} baud, using {self.baud_rate}')
+        return None
+    
+    def openSerial(self, baud_rate: int):
+        self.serial = serial.Serial(self.serial_port, baudrate=baud_rate, bytesize=serial.SEVENBITS, parity=serial.PARITY_ODD, stopbits=1, timeout=self.read_timeout)
+        self.read_buffer.clear()
+    
+    def closeSerial(self):
+        try:
+            if self.serial and self.serial.is_open:
+                self.serial.close()
+        except:
+            pass
     
     def readWriteProbe(self):
-        last_info_update = time.time()
-        last_data_update = time.time()
-        alerted = 0
+        # Supervises the probe session. A serial failure closes the port and reopens it on this
+        # thread with exponential backoff, the scheduler keeps whatever was queued meanwhile.
         while not self.stop_probe_event.is_set() and self.is_running:
-            if time.time() - last_data_update >= self.data_interval:
-                self.getFieldStrengthMeasurement()
-                last_data_update = time.time()
-            if time.time() - last_info_update >= self.info_interval:
-                self.getBatteryPercentage()
-                self.getTemperature()
-                last_info_update = time.time()
-            if not self.command_queue.empty():
-                serial_command: SerialCommand = self.command_queue.get()
-                try:
-                    self.serial.write(serial_command.command)
-                    response = self.serial.read(serial_command.blocksize)
-                except:
-                    self.serialConnectionError.emit('Serial Communication Error')
+            try:
+                answered = self.negotiateBaudRate()
+                self.baudRateSelected.emit(self.baud_rate)
+                self.scheduler.setBaudRate(self.baud_rate)
+                if self.lost_time is not None:
+                    if answered is None:
+                        # The port is back but the probe isn't, keep backing off
+                        raise SerialException('Probe did not answer after reconnect')
+                    self.reportReconnect()
+                self.runSession()
+            except (SerialException, OSError) as e:
+                # Anything else is a bug, not a lost probe, and must not be retried forever
+                if self.stop_probe_event.is_set():
+                    break
+                if self.lost_time is None:
+                    self.lost_time = time.perf_counter()
+                # Replies to these will never come, field requests are regenerated anyway
+                self.scheduler.requeue(self.in_flight)
+                self.in_flight.clear()
+                self.connectionLost.emit(str(e) or 'Serial Communication Error')
+                print(f'{self.serial_port} lost: {e}')
+                if not self.reconnect():
                     break
-                error, message = serial_command.checkForError(response)
-                if error:
-                    self.fieldProbeError.emit(message)
-                else:
-                    if type(serial_command) == IdentityCommand:
-                        try:
-                            model, revision, serial, calibration = serial_command.parse(message)
-                        except:
-                            self.fieldProbeError.emit(f'Error Reading Probe Identity: {message}')
-                        self.identityReceived.emit(model, revision, serial, calibration)
-                    elif type(serial_command) == CompositeDataCommand:
-                        try:
-                            x, y, z, composite = serial_command.parse(message)
-                        except:
-                            self.fieldProbeError.emit(f'Error Reading Field Intensity: {message}')
-                        self.fieldIntensityReceived.emit(x, y, z, composite)
-                    elif type(serial_command) == BatteryCommand:
-                        try:
-                            percentage = serial_command.parse(message)
-                        except:
-                            self.fieldProbeError.emit(f'Error Reading Battery Level: {message}')
-                        self.batteryReceived.emit(percentage)
-                    elif type(serial_command) == TemperatureCommand:
-                        try:
-                            temperature = serial_command.parse(message)
-                        except:
-                            self.fieldProbeError.emit(f'Error Reading Temperature: {message}')
-                        self.temperatureReceived.emit(temperature)
-                    else:
-                        self.fieldProbeError.emit('Unknown Command & Response')
-                    
-                    
\ No newline at end of file
+        self.in_flight.clear()
+    
+    def reconnect(self) -> bool:
+        # Returns False if stopped or the port stayed away longer than max_downtime
+        self.closeSerial()
+        delay = self.reconnect_delay
+        self.reconnect_attempts = 0
+        while not self.stop_probe_event.is_set():
+            self.reconnect_attempts += 1
+            self.reconnect_start = time.perf_counter()
+            try:
+                # The probe is still at the rate it was negotiated at
+                self.openSerial(self.baud_rate)
+                return True
+            except (SerialException, OSError, ValueError):
+                pass
+            if time.perf_counter() - self.lost_time > self.max_downtime:
+                self.is_running = False
+                self.serialConnectionError.emit(f'Probe did not come back within {self.max_downtime:g} s')
+                return False
+            if self.stop_probe_event.wait(delay):
+                return False
+            delay = min(delay * 2, self.max_reconnect_delay)
+        return False
+    
+    def reportReconnect(self):
+        now = time.perf_counter()
+        reconnect_time = now - self.reconnect_start
+        downtime = now - self.lost_time
+        self.lost_time = None
+        self.connection_stats['reconnects'] += 1
+        self.connection_stats['attempts'] += self.reconnect_attempts
+        self.connection_stats['last_reconnect'] = reconnect_time
+        self.connection_stats['last_downtime'] = downtime
+        self.connection_stats['max_downtime'] = max(self.connection_stats['max_downtime'], downtime)
+        self.connection_stats['total_downtime'] += downtime
+        self.probeReconnected.emit(reconnect_time, downtime)
+        print(f'{self.serial_port} reconnected in {reconnect_time * 1000:.1f} ms after {self.reconnect_attempts} attempts, {downtime * 1000:.1f} ms down')
+    
+    def getConnectionStats(self) -> dict:
+        return dict(self.connection_stats)
+    
+    def runSession(self):
+        # Blocks on the serial read or in the scheduler, never spins. Serial errors propagate
+        # to readWriteProbe.
+        last_report = time.perf_counter()
+        last_sample_count = self.samples.count
+        in_flight = self.in_flight
+        while not self.stop_probe_event.is_set() and self.is_running:
+            now = time.perf_counter()
+            if now - last_report >= self.info_interval:
+                self.sample_rate = (self.samples.count - last_sample_count) / (now - last_report)
+                self.sampleRateMeasured.emit(self.sample_rate)
+                self.schedulerStats.emit(self.scheduler.summary())
+                last_sample_count = self.samples.count
+                last_report = now
+            while len(in_flight) < self.pipeline_depth:
+                entry = self.scheduler.next(block=len(in_flight) == 0)
+                if entry is None or self.stop_probe_event.is_set():
+                    break
+                in_flight.append(entry)
+                self.serial.write(entry[0].command)
+            if len(in_flight) == 0:
+                continue
+            response = self.readResponse()
+            timestamp = time.perf_counter()
+            if self.stop_probe_event.is_set():
+                break
+            serial_command, command_class, enqueued = in_flight.popleft()
+            if not response.endswith(b'\r') or response[1:2] not in (serial_command.command[:1], b'E'):
+                # Timed out or out of step, drop everything outstanding so the next reply lines up
+                self.serial.reset_input_buffer()
+                self.read_buffer.clear()
+                in_flight.clear()
+                self.fieldProbeError.emit(f'Probe response lost: {serial_command.command.decode()}')
+                continue
+            self.handleResponse(serial_command, response, timestamp)
+            self.scheduler.complete(command_class, enqueued, timestamp)
+            
+    def readResponse(self) -> bytes:
+        # One CR terminated reply, or whatever arrived before the read timed out. Reads whatever
+        # is waiting rather than a byte at a time like read_until.
+        while True:
+            end = self.read_buffer.find(b'\r')
+            if end >= 0:
+                response = bytes(self.read_buffer[:end + 1])
+                del self.read_buffer[:end + 1]
+                return response
+            if len(self.read_buffer) >= self.max_response_length:
+                break
+            data = self.serial.read(max(1, self.serial.in_waiting))
+            if len(data) == 0:
+                break
+            self.read_buffer += data
+        response = bytes(self.read_buffer)
+        self.read_buffer.clear()
+        return response
+    
+    def handleResponse(self, serial_command: SerialCommand, response: bytes, timestamp: float):
+        if serial_command is self.field_command and serial_command.parseBytes(response):
+            self.samples.append(timestamp, serial_command.x, serial_command.y, serial_command.z, serial_command.composite)
+            self.fieldIntensityReceived.emit(serial_command.x, serial_command.y, serial_command.z, serial_command.composite)
+            return
+        error, message = serial_command.checkForError(response)
+        if error:
+            self.fieldProbeError.emit(message)
+            return
+        if type(serial_command) == IdentityCommand:
+            try:
+                model, revision, serial, calibration = serial_command.parse(message)
+            except:
+                self.fieldProbeError.emit(f'Error Reading Probe Identity: {message}')
+                return
+            self.identityReceived.emit(model, revision, serial, calibration)
+        elif type(serial_command) == CompositeDataCommand:
+            try:
+                x, y, z, composite = serial_command.parse(message)
+            except:
+                self.fieldProbeError.emit(f'Error Reading Field Intensity: {message}')
+                return
+            self.samples.append(timestamp, x, y, z, composite)
+            self.fieldIntensityReceived.emit(x, y, z, composite)
+        elif type(serial_command) == BatteryCommand:
+            try:
+                percentage = serial_command.parse(message)
+            except:
+                self.fieldProbeError.emit(f'Error Reading Battery Level: {message}')
+                return
+            self.batteryReceived.emit(percentage)
+        elif type(serial_command) == TemperatureCommand:
+            try:
+                temperature = serial_command.parse(message)
+            except:
+                self.fieldProbeError.emit(f'Error Reading Temperature: {message}')
+                return
+            self.temperatureReceived.emit(temperature)
+        else:
+            self.fieldProbeError.emit('Unknown Command & Response')
@@ -0,0 +1,77 @@
+import csv
+from bisect import bisect_right
+
+
+class GainSchedule():
+    # PID gains by amplifier, antenna, frequency band and target field. Bands of one amplifier and
+    # antenna pair must not overlap, and neither may the target ranges within one band, so each
+    # lookup is two binary searches over interval starts. Frequencies are in Hz, a band covers
+    # [min, max) and so does a target range.
+    #
+    # load() reads a CSV with a header row of
+    #   amplifier,antenna,min_mhz,max_mhz,min_level,max_level,Kp,Ki,Kd
+    # and levels in V/m.
+
+    def __init__(self):
+        # (amplifier, antenna) -> [band starts], [(band end, [level starts], [(level end, gains)])]
+        self.tables = {}
+        # Band starts and bands of the selected pair, swapped as one so the control thread never
+        # sees half a selection
+        self.selected = ([], [])
+
+    def __len__(self) -> int:
+        return sum(len(levels) for _, bands in self.tables.values() for _, _, levels in bands)
+
+    def add(self, amplifier: str, antenna: str, min_frequency: float, max_frequency: float, min_level: float, max_level: float, gains: tuple):
+        if min_frequency >= max_frequency or min_level >= max_level:
+            raise ValueError(f'Empty gain schedule range: {min_frequency}-{max_frequency} Hz, {min_level}-{max_level} V/m')
+        starts, bands = self.tables.setdefault((amplifier, antenna), ([], []))
+        index = bisect_right(starts, min_frequency) - 1
+        if index >= 0 and starts[index] == min_frequency and bands[index][0] == max_frequency:
+            # Another target range of a band already in the table
+            band = bands[index]
+        else:
+            if (index >= 0 and bands[index][0] > min_frequency) or (index + 1 < len(starts) and starts[index + 1] < max_frequency):
+                raise ValueError(f'Gain schedule band {min_frequency}-{max_frequency} Hz overlaps another for {amplifier} with {antenna}')
+            band = (max_frequency, [], [])
+            starts.insert(index + 1, min_frequency)
+            bands.insert(index + 1, band)
+        level_starts, levels = band[1], band[2]
+        position = bisect_right(level_starts, min_level) - 1
+        if (position >= 0 and levels[position][0] > min_level) or (position + 1 < len(level_starts) and level_starts[position + 1] < max_level):
+            raise ValueError(f'Gain schedule target range {min_level}-{max_level} V/m overlaps another at {min_frequency}-{max_frequency} Hz')
+        level_starts.insert(position + 1, min_level)
+        levels.insert(position + 1, (max_level, tuple(gains)))
+
+    def load(self, path: str) -> int:
+        # Number of entries read
+        count = 0
+        with open(path, newline='') as file:
+            for row in csv.DictReader(file):
+                self.add(row['amplifier'].strip(), row['antenna'].strip(),
+                         float(row['min_mhz']) * 1e6, float(row['max_mhz']) * 1e6,
+                         float(row['min_level']), float(row['max_level']),
+                         (float(row['Kp']), float(row['Ki']), float(row['Kd'])))
+                count += 1
+        return count
+
+    def select(self, amplifier: str, antenna: str):
+        # Makes lookup() use this pair's bands, a pair without any leaves the schedule empty
+        self.selected = self.tables.get((amplifier, antenna), ([], []))
+
+    def lookup(self, frequency: float, level: float) -> tuple:
+        # (Kp, Ki, Kd) for the selected pair, None where the schedule has nothing
+        starts, bands = self.selected
+        index = bisect_right(starts, frequency) - 1
+        if index < 0:
+            return None
+        max_frequency, level_starts, levels = bands[index]
+        if frequency >= max_frequency:
+            return None
+        position = bisect_right(level_starts, level) - 1
+        if position < 0:
+            return None
+        max_level, gains = levels[position]
+        if level >= max_level:
+            return None
+        return gains
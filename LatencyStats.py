@@ -0,0 +1,164 @@
+import math
+import threading
+import time
+from enum import Enum
+
+
+class LatencyStage(Enum):
+    QUEUED = 'queued'
+    WRITE = 'write'
+    ACK = 'ack'
+    EMIT = 'emit'
+    TOTAL = 'total'
+
+
+class LatencyHistogram():
+    # Log-linear buckets in the style of HdrHistogram: every power of two above min_value is
+    # split into sub_buckets equal bins, so a recorded value is off by at most 1/sub_buckets.
+
+    def __init__(self, min_value: float = 1e-6, max_value: float = 100.0, sub_buckets: int = 16):
+        self.min_value = min_value
+        self.sub_buckets = sub_buckets
+        octaves = int(math.ceil(math.log2(max_value / min_value)))
+        self.counts = [0] * (octaves * sub_buckets + 1)
+        self.count = 0
+
+    def index(self, value: float) -> int:
+        if value <= self.min_value:
+            return 0
+        mantissa, exponent = math.frexp(value / self.min_value)
+        bucket = 1 + (exponent - 1) * self.sub_buckets + int((mantissa * 2.0 - 1.0) * self.sub_buckets)
+        return min(bucket, len(self.counts) - 1)
+
+    def upperBound(self, bucket: int) -> float:
+        if bucket == 0:
+            return self.min_value
+        octave, sub = divmod(bucket - 1, self.sub_buckets)
+        return self.min_value * pow(2, octave) * (1.0 + (sub + 1) / self.sub_buckets)
+
+    def record(self, value: float):
+        self.counts[self.index(value)] += 1
+        self.count += 1
+
+    def merge(self, other: 'LatencyHistogram'):
+        for bucket, count in enumerate(other.counts):
+            self.counts[bucket] += count
+        self.count += other.count
+
+    def percentile(self, percent: float) -> float:
+        if self.count == 0:
+            return 0.0
+        target = max(1, int(math.ceil(self.count * percent / 100.0)))
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.upperBound(bucket)
+        return self.upperBound(len(self.counts) - 1)
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+
+
+class RollingHistogram():
+    # Covers roughly the last window seconds by rotating through slices histograms
+
+    def __init__(self, window: float = 10.0, slices: int = 5):
+        self.slice_length = window / slices
+        self.slices = [LatencyHistogram() for _ in range(slices)]
+        self.current = 0
+        self.slice_start = time.perf_counter()
+        self.started = self.slice_start
+
+    def rotate(self, now: float):
+        while now - self.slice_start >= self.slice_length:
+            self.current = (self.current + 1) % len(self.slices)
+            self.slices[self.current].reset()
+            self.slice_start += self.slice_length
+
+    def record(self, value: float, now: float):
+        self.rotate(now)
+        self.slices[self.current].record(value)
+
+    def snapshot(self, now: float) -> LatencyHistogram:
+        self.rotate(now)
+        merged = LatencyHistogram()
+        for histogram in self.slices:
+            merged.merge(histogram)
+        return merged
+
+    def slicesCounts(self, now: float) -> list:
+        # Copies of the raw bucket counts of every slice, for merging somewhere cheaper
+        self.rotate(now)
+        return [list(histogram.counts) for histogram in self.slices]
+
+    def span(self, now: float) -> float:
+        # Time the surviving slices actually cover
+        return min(now - self.started, self.slice_length * (len(self.slices) - 1) + (now - self.slice_start))
+
+
+class CommandLatencyStats():
+    # Rolling per-command, per-stage latency, recorded from the SCPI write thread
+
+    def __init__(self, window: float = 10.0):
+        self.window = window
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def record(self, key: Enum, stage: LatencyStage, seconds: float, now: float):
+        with self.lock:
+            stages = self.histograms.get(key)
+            if stages is None:
+                stages = {stage: RollingHistogram(self.window) for stage in LatencyStage}
+                self.histograms[key] = stages
+            stages[stage].record(seconds, now)
+
+    def snapshot(self) -> dict:
+        # {key name: {stage name: (slice bucket counts, span)}}, only list copies so the write thread
+        # can take one every statsInterval. summarise() does the merging and percentiles.
+        now = time.perf_counter()
+        snapshot = {}
+        with self.lock:
+            for key, stages in self.histograms.items():
+                snapshot[key.name] = {stage.value: (rolling.slicesCounts(now), rolling.span(now)) for stage, rolling in stages.items()}
+        return snapshot
+
+    @staticmethod
+    def summarise(snapshot: dict) -> dict:
+        # {key name: {'throughput': commands/s, stage name: {'count', 'p50', 'p99', 'max'}}}
+        summary = {}
+        for name, stages in snapshot.items():
+            entry = {}
+            for stage, (slices, span) in stages.items():
+                histogram = LatencyHistogram()
+                histogram.counts = [sum(counts) for counts in zip(*slices)]
+                histogram.count = sum(histogram.counts)
+                entry[stage] = {
+                    'count': histogram.count,
+                    'p50': histogram.percentile(50.0),
+                    'p99': histogram.percentile(99.0),
+                    'max': histogram.percentile(100.0),
+                }
+            span = stages[LatencyStage.TOTAL.value][1]
+            entry['throughput'] = entry[LatencyStage.TOTAL.value]['count'] / span if span > 0 else 0.0
+            summary[name] = entry
+        return summary
+
+    def summary(self) -> dict:
+        return self.summarise(self.snapshot())
+
+    def dump(self) -> str:
+        lines = [f'{"Command":18}{"Stage":8}{"Count":>8}{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}{"cmd/s":>10}']
+        for name, entry in self.summary().items():
+            for stage in LatencyStage:
+                stats = entry[stage.value]
+                if stats['count'] == 0:
+                    continue
+                throughput = f'{entry["throughput"]:10.1f}' if stage == LatencyStage.TOTAL else ''
+                lines.append(f'{name:18}{stage.value:8}{stats["count"]:8d}{stats["p50"] * 1000:10.3f}{stats["p99"] * 1000:10.3f}{stats["max"] * 1000:10.3f}{throughput}')
+        return '\n'.join(lines)
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
@@ -1,10 +1,12 @@
 import sys
 import random
+import numpy as np
 from PyQt5.QtWidgets import QApplication, QMainWindow, QVBoxLayout, QWidget, QPushButton
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
+from SampleBuffer import TIME, X, Y, Z, COMPOSITE
 
 class FrequencyPlot(FigureCanvas):
     def __init__(self, parent=None, width=5, height=4, dpi=100):
@@ -64,19 +66,16 @@ class PowerPlot(FigureCanvas):
         super().__init__(self.fig)
         self.setParent(parent)
         
-        # Data to plot
+        # Probe samples are read from the probe's SampleRingBuffer on every update, only the
+        # setpoint history is kept here
         self.time_data = []
         self.setpoint_data = []
-        self.composite_data = []
-        self.x_data = []
-        self.y_data = []
-        self.z_data = []
         
-        self.line1, = self.ax.plot(self.time_data, self.setpoint_data, '-b', label='Setpoint')
-        self.line2, = self.ax.plot(self.time_data, self.composite_data, '-r', label='Composite')
-        self.line3, = self.ax.plot(self.time_data, self.x_data, '-g', label='X')
-        self.line4, = self.ax.plot(self.time_data, self.y_data, '-c', label='Y')
-        self.line5, = self.ax.plot(self.time_data, self.z_data, '-y', label='Z')
+        self.line1, = self.ax.plot([], [], '-b', label='Setpoint')
+        self.line2, = self.ax.plot([], [], '-r', label='Composite')
+        self.line3, = self.ax.plot([], [], '-g', label='X')
+        self.line4, = self.ax.plot([], [], '-c', label='Y')
+        self.line5, = self.ax.plot([], [], '-y', label='Z')
         
         self.ax.set_xlim(0, 10)
         self.ax.set_ylim(0, 10)
@@ -102,10 +101,8 @@ class PowerPlot(FigureCanvas):
         print("Clearing plot")
         self.time_data.clear()
         self.setpoint_data.clear()
-        self.composite_data.clear()
-        self.x_data.clear()
-        self.y_data.clear()
-        self.z_data.clear()
+        for line in (self.line1, self.line2, self.line3, self.line4, self.line5):
+            line.set_data([], [])
         
         self.ax.set_xlim(0, self.ax.get_xlim()[1] - self.ax.get_xlim()[0])
         self.ax.relim()
@@ -113,33 +110,30 @@ class PowerPlot(FigureCanvas):
         self.draw_idle()
         return self.line1, self.line2, self.line3, self.line4, self.line5
 
-    def update_plot(self, time: float, setpoint: float, composite: float, x: float, y: float, z: float):
-        #print("Updating plot: time = {}, composite = {}, x = {}, y = {}, z = {}".format(time, setpoint, composite, x, y, z))
+    def update_plot(self, samples: np.ndarray, start_time: float, time: float, setpoint: float):
+        # samples are (timestamp, x, y, z, composite) rows with timestamps on the same clock as start_time
         self.time_data.append(time)
         self.setpoint_data.append(setpoint)
-        self.composite_data.append(composite)
-        self.x_data.append(x)
-        self.y_data.append(y)
-        self.z_data.append(z)
         
-        if (time > self.ax.get_xlim()[1]):
-            self.time_data.pop(0)
-            self.setpoint_data.pop(0)
-            self.composite_data.pop(0)
-            self.x_data.pop(0)
-            self.y_data.pop(0)
-            self.z_data.pop(0)
-            self.ax.set_xlim(self.time_data[0], self.time_data[-1] + 0.1)
-            
+        x_min, x_max = self.ax.get_xlim()
+        if (time > x_max):
+            x_min, x_max = time - (x_max - x_min) + 0.1, time + 0.1
+            self.ax.set_xlim(x_min, x_max)
+            while self.time_data[0] < x_min:
+                self.time_data.pop(0)
+                self.setpoint_data.pop(0)
+        
+        samples = samples[np.searchsorted(samples[:, TIME], start_time + x_min):]
+        sample_time = samples[:, TIME] - start_time
         self.line1.set_data(self.time_data, self.setpoint_data)
-        self.line2.set_data(self.time_data, self.composite_data)
-        self.line3.set_data(self.time_data, self.x_data)
-        self.line4.set_data(self.time_data, self.y_data)
-        self.line5.set_data(self.time_data, self.z_data)
+        self.line2.set_data(sample_time, samples[:, COMPOSITE])
+        self.line3.set_data(sample_time, samples[:, X])
+        self.line4.set_data(sample_time, samples[:, Y])
+        self.line5.set_data(sample_time, samples[:, Z])
         
         self.ax.relim()
         self.ax.autoscale_view()
 
         self.draw_idle()
         
-        return self.line1, self.line2, self.line3, self.line4, self.line5
\ No newline at end of file
+        return self.line1, self.line2, self.line3, self.line4, self.line5
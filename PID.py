@@ -1,37 +1,143 @@
+import math
+import time
+from enum import Enum
+
+
+class AntiWindup(Enum):
+    NONE = 'none'
+    # Stop integrating while the output is limited and the error pushes further into the limit
+    CONDITIONAL = 'conditional'
+    # Bleed the integral towards the limited output with time constant tracking_time
+    BACK_CALCULATION = 'back_calculation'
+
+
 class PIDController():
-    
-    def __init__(self, Kp, Ki, Kd):
+    # Positional PID on measured sample times: Ki is per second, Kd in seconds, so the tuning holds
+    # whatever rate the probe delivers at. The output is the absolute power in dBm, limited to
+    # output limits and a slew rate in dBm/s. The derivative acts on the measurement, not the
+    # error, so a setpoint change doesn't kick the output, and is low-pass filtered with time
+    # constant derivative_filter. calculate() does no I/O.
+
+    def __init__(self, Kp, Ki, Kd, derivative_filter: float = 0.02, anti_windup: AntiWindup = AntiWindup.BACK_CALCULATION):
         self.Kp = Kp
         self.Ki = Ki
         self.Kd = Kd
-        self.prev_error = 0.0
-        self.integral = 0.0
+        self.derivative_filter = derivative_filter
+        self.anti_windup = anti_windup
+        # None picks sqrt(Ti * Td), or Ti without a derivative term
+        self.tracking_time = None
+        self.min_output = -math.inf
+        self.max_output = math.inf
+        self.slew_rate = math.inf
+        # A longer gap between samples, e.g. a probe reconnect, counts as this long
+        self.max_dt = 0.5
         self.desired_field = 1.0
         self.current_field = 0.0
-    
+        self.integral = 0.0
+        self.derivative = 0.0
+        self.output = 0.0
+        self.prev_measurement = None
+        self.prev_time = None
+        # +1 or -1 while the output is held at a limit, 0 otherwise
+        self.saturation = 0
+
     def setGains(self, Kp: float, Ki: float, Kd: float):
         print(f"PID gains set to: Kp = {Kp}, Ki = {Ki}, Kd = {Kd}")
         self.Kp = Kp
         self.Ki = Ki
         self.Kd = Kd
-    
+
+    def switchGains(self, Kp: float, Ki: float, Kd: float):
+        # Bumpless gain change from the control thread: the integral takes up the step the new
+        # proportional and derivative gains would put on the output. The integral holds Ki * the
+        # integrated error, so a new Ki only changes what is integrated from now on.
+        error = self.desired_field - self.current_field
+        derivative = self.derivative * (Kd / self.Kd) if self.Kd != 0.0 else 0.0
+        if self.prev_time is not None:
+            self.integral += (self.Kp - Kp) * error + (self.derivative - derivative)
+        self.derivative = derivative
+        self.Kp = Kp
+        self.Ki = Ki
+        self.Kd = Kd
+
     def setTargetValue(self, setpoint: float):
         print(f"Desired field set to: {setpoint}")
         self.desired_field = setpoint
-        
+
     def getTargetValue(self) -> float:
         return self.desired_field
-    
-    def calculate(self, current_field: float) -> float:
+
+    def setOutputLimits(self, minimum: float, maximum: float):
+        self.min_output = minimum
+        self.max_output = maximum
+
+    def setSlewRate(self, rate: float):
+        # dBm per second in either direction, math.inf for none
+        self.slew_rate = rate
+
+    def setAntiWindup(self, anti_windup: AntiWindup, tracking_time: float = None):
+        self.anti_windup = anti_windup
+        self.tracking_time = tracking_time
+
+    def trackingTime(self) -> float:
+        if self.tracking_time is not None:
+            return self.tracking_time
+        if self.Ki <= 0.0:
+            return math.inf
+        if self.Kd > 0.0:
+            return math.sqrt(self.Kd / self.Ki)
+        return abs(self.Kp) / self.Ki if self.Kp != 0.0 else 1.0 / self.Ki
+
+    def reset(self, output: float):
+        # Bumpless start from output, e.g. the power the generator is at now
+        self.integral = output
+        self.derivative = 0.0
+        self.output = output
+        self.prev_measurement = None
+        self.prev_time = None
+        self.saturation = 0
+
+    def calculate(self, current_field: float, timestamp: float = None) -> float:
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        self.current_field = current_field
         error = self.desired_field - current_field
-        self.integral += error
-        derivative = error - self.prev_error
-        output = (self.Kp * error) + (self.Ki * self.integral) + (self.Kd * derivative)
-        self.prev_error = error
-        print(f"Current Field: {current_field}, Error: {error}, Integral: {self.integral}, Derivative: {derivative}, Output: {output}")
+        if self.prev_time is None:
+            # First sample after a reset carries on from the current output
+            self.integral = self.output - self.Kp * error
+            dt = 0.0
+        else:
+            dt = min(timestamp - self.prev_time, self.max_dt)
+        if dt > 0.0:
+            self.integral += self.Ki * error * dt
+            self.derivative = (self.derivative_filter * self.derivative - self.Kd * (current_field - self.prev_measurement)) / (self.derivative_filter + dt)
+        elif self.prev_time is not None:
+            # Same timestamp as last time, nothing new to act on
+            return self.output
+        unlimited = self.Kp * error + self.integral + self.derivative
+        output = min(max(unlimited, self.min_output), self.max_output)
+        if dt > 0.0:
+            step = self.slew_rate * dt
+            output = min(max(output, self.output - step), self.output + step)
+        if output < unlimited:
+            self.saturation = 1
+        elif output > unlimited:
+            self.saturation = -1
+        else:
+            self.saturation = 0
+        if self.saturation != 0 and dt > 0.0:
+            if self.anti_windup == AntiWindup.CONDITIONAL:
+                if (self.saturation > 0 and error > 0.0) or (self.saturation < 0 and error < 0.0):
+                    self.integral -= self.Ki * error * dt
+            elif self.anti_windup == AntiWindup.BACK_CALCULATION:
+                tracking_time = self.trackingTime()
+                if tracking_time < math.inf:
+                    self.integral += (output - unlimited) * min(dt / tracking_time, 1.0)
+        self.output = output
+        self.prev_measurement = current_field
+        self.prev_time = timestamp
         return output
-    
+
     def clear(self):
-        self.measured_value = 0.0
-        self.prev_error = 0.0
-        self.integral = 0.0
\ No newline at end of file
+        # Forgets the history but holds the output where it is
+        self.reset(self.output)
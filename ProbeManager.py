@@ -0,0 +1,160 @@
+import math
+import threading
+import time
+import numpy as np
+from enum import Enum
+from PyQt5.QtCore import QObject, pyqtSignal, Qt
+from FieldProbe import ETSLindgrenHI6006
+from SampleBuffer import SampleRingBuffer, TIME, X, Y, Z, COMPOSITE
+
+
+class Aggregate(Enum):
+    MEAN = 'mean'
+    MIN = 'min'
+    MAX = 'max'
+
+
+class ProbeManager(QObject):
+    # Runs several HI-6006 probes, each on its own port and thread, and combines them into one
+    # field reading. Stands in for a single ETSLindgrenHI6006: same signals, start/stop and a
+    # samples buffer, which here holds the aggregate the control loop regulates on. Rates and
+    # scheduler statistics are combined over the probes, getters give them per port.
+    fieldIntensityReceived = pyqtSignal(float, float, float, float)
+    identityReceived = pyqtSignal(str, str, str, str)
+    batteryReceived = pyqtSignal(int)
+    temperatureReceived = pyqtSignal(float)
+    serialConnectionError = pyqtSignal(str)
+    fieldProbeError = pyqtSignal(str)
+    connectionLost = pyqtSignal(str)
+    probeReconnected = pyqtSignal(float, float)
+    baudRateSelected = pyqtSignal(int)
+    # Slowest probe's rate, the aggregate can't run faster
+    sampleRateMeasured = pyqtSignal(float)
+    # Latest scheduler summary of every probe, by port
+    schedulerStats = pyqtSignal(dict)
+    aggregateReceived = pyqtSignal(dict)
+
+    def __init__(self, serial_ports: tuple = ('COM5',), baud_rates: tuple = (115200, 9600), sample_capacity: int = 65536):
+        super().__init__()
+        self.serial_ports = list(serial_ports)
+        self.probes = [ETSLindgrenHI6006(port, baud_rates, sample_capacity) for port in self.serial_ports]
+        self.samples = SampleRingBuffer(sample_capacity)
+        self.aggregate = Aggregate.MEAN
+        # Probes without a sample this recent are left out of the aggregate
+        self.max_age = 0.5
+        self.last_aggregate_time = 0.0
+        self.aggregate_lock = threading.Lock()
+        self.scheduler_stats = {}
+        for probe in self.probes:
+            port = probe.serial_port
+            # Runs on the probe thread right after the sample lands in the probe's buffer
+            probe.fieldIntensityReceived.connect(self.aggregateSamples, Qt.DirectConnection)
+            probe.identityReceived.connect(self.identityReceived)
+            probe.batteryReceived.connect(self.batteryReceived)
+            probe.temperatureReceived.connect(self.temperatureReceived)
+            probe.serialConnectionError.connect(lambda message, port=port: self.serialConnectionError.emit(f'{port}: {message}'))
+            probe.fieldProbeError.connect(lambda message, port=port: self.fieldProbeError.emit(f'{port}: {message}'))
+            probe.connectionLost.connect(lambda message, port=port: self.connectionLost.emit(f'{port}: {message}'))
+            probe.probeReconnected.connect(self.probeReconnected)
+            probe.baudRateSelected.connect(self.baudRateSelected)
+            probe.sampleRateMeasured.connect(self.reportSampleRate, Qt.DirectConnection)
+            probe.schedulerStats.connect(lambda stats, port=port: self.reportSchedulerStats(port, stats), Qt.DirectConnection)
+
+    def start(self):
+        self.last_aggregate_time = 0.0
+        for probe in self.probes:
+            probe.start()
+
+    def stop(self):
+        for probe in self.probes:
+            probe.stop()
+
+    def getConnectionStats(self) -> dict:
+        return {port: probe.getConnectionStats() for port, probe in zip(self.serial_ports, self.probes)}
+
+    def setRegulating(self, regulating: bool):
+        for probe in self.probes:
+            probe.setRegulating(regulating)
+
+    def setPipelined(self, pipelined: bool, depth: int = 2):
+        for probe in self.probes:
+            probe.setPipelined(pipelined, depth)
+
+    def getSampleRate(self) -> float:
+        # Probes that haven't measured a rate yet don't count
+        rates = [probe.getSampleRate() for probe in self.probes if probe.getSampleRate() > 0.0]
+        return min(rates) if len(rates) > 0 else 0.0
+
+    def getSampleRates(self) -> dict:
+        return {port: probe.getSampleRate() for port, probe in zip(self.serial_ports, self.probes)}
+
+    def getBaudRates(self) -> dict:
+        return {port: probe.getBaudRate() for port, probe in zip(self.serial_ports, self.probes)}
+
+    def getSchedulerStats(self) -> dict:
+        return {port: probe.getSchedulerStats() for port, probe in zip(self.serial_ports, self.probes)}
+
+    def reportSampleRate(self, rate: float):
+        # Runs on whichever probe thread measured a rate
+        self.sampleRateMeasured.emit(self.getSampleRate())
+
+    def reportSchedulerStats(self, port: str, stats: dict):
+        self.scheduler_stats[port] = stats
+        self.schedulerStats.emit(dict(self.scheduler_stats))
+
+    def setAggregate(self, aggregate: Aggregate):
+        self.aggregate = aggregate
+
+    def getAggregate(self) -> Aggregate:
+        return self.aggregate
+
+    def alignedSamples(self) -> tuple[float, list]:
+        # Every live probe interpolated at the newest time they have all reached, so the
+        # aggregate never mixes a fresh reading from a fast probe with a stale one from a slow one
+        stale = time.perf_counter() - self.max_age
+        live = []
+        for probe, port in zip(self.probes, self.serial_ports):
+            latest = probe.samples.latest()
+            if latest is not None and latest[TIME] >= stale:
+                live.append((port, probe.samples))
+        if len(live) == 0:
+            return None, []
+        common_time = min(samples.latest()[TIME] for _, samples in live)
+        aligned = []
+        for port, samples in live:
+            sample = samples.at(common_time)
+            if sample is not None:
+                aligned.append((port, sample))
+        return common_time, aligned
+
+    def aggregateSamples(self, *args):
+        with self.aggregate_lock:
+            common_time, aligned = self.alignedSamples()
+            if common_time is None or common_time <= self.last_aggregate_time or len(aligned) == 0:
+                return
+            self.last_aggregate_time = common_time
+            rows = np.array([sample for _, sample in aligned])
+            composites = rows[:, COMPOSITE]
+            minimum = float(composites.min())
+            maximum = float(composites.max())
+            if self.aggregate == Aggregate.MIN:
+                selected = rows[composites.argmin()]
+            elif self.aggregate == Aggregate.MAX:
+                selected = rows[composites.argmax()]
+            else:
+                selected = rows.mean(axis=0)
+            self.samples.append(common_time, selected[X], selected[Y], selected[Z], selected[COMPOSITE])
+        self.aggregateReceived.emit({
+            'time': float(common_time),
+            'count': len(aligned),
+            'ports': [port for port, _ in aligned],
+            'composites': composites.tolist(),
+            'min': minimum,
+            'max': maximum,
+            'mean': float(composites.mean()),
+            'spread': maximum - minimum,
+            # Field uniformity is judged in dB
+            'spread_db': 20.0 * math.log10(maximum / minimum) if minimum > 0 else math.inf,
+            'aggregate': self.aggregate.value,
+        })
+        self.fieldIntensityReceived.emit(float(selected[X]), float(selected[Y]), float(selected[Z]), float(selected[COMPOSITE]))
@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import deque
+from enum import Enum
+from LatencyStats import LatencyHistogram
+
+
+class CommandClass(Enum):
+    CONTROL = 'control'
+    FIELD = 'field'
+    HOUSEKEEPING = 'housekeeping'
+
+
+class ProbeScheduler():
+    # Decides what goes on the probe's serial line next. Explicit requests (identity, anything
+    # queued from outside) go first, then field data every data_interval. Battery and temperature
+    # queries are generated every info_interval but while regulating they only run in a gap
+    # before the next field request that is long enough to hold them, or once they have waited
+    # max_defer, so the control loop never loses a sample to housekeeping it can do without.
+
+    def __init__(self, field_command, housekeeping: tuple = (), data_interval: float = 0.0005, info_interval: float = 2.0, max_defer: float = 10.0):
+        self.field_command = field_command
+        # Factories for the periodic housekeeping commands
+        self.housekeeping = housekeeping
+        self.data_interval = data_interval
+        self.info_interval = info_interval
+        self.max_defer = max_defer
+        # Wire time of one character, set once the baud rate is known
+        self.char_time = 10 / 9600
+        # Probe processing time on top of the wire time
+        self.turnaround = 0.002
+        self.regulating = False
+        self.condition = threading.Condition()
+        self.control = deque()
+        self.deferred = deque()
+        self.next_data = 0.0
+        self.next_info = 0.0
+        self.reset()
+
+    def reset(self):
+        with self.condition:
+            self.control.clear()
+            self.deferred.clear()
+            now = time.perf_counter()
+            self.next_data = now
+            self.next_info = now + self.info_interval
+            self.resetStats()
+
+    def resetStats(self):
+        self.latency = {command_class: LatencyHistogram() for command_class in CommandClass}
+        self.max_wait = {command_class: 0.0 for command_class in CommandClass}
+        self.field_gaps = LatencyHistogram()
+        self.last_field = None
+        self.in_gap = 0
+        self.forced = 0
+
+    def submit(self, command, command_class: CommandClass = CommandClass.CONTROL):
+        with self.condition:
+            if command_class == CommandClass.HOUSEKEEPING:
+                self.deferred.append((command, command_class, time.perf_counter()))
+            else:
+                self.control.append((command, command_class, time.perf_counter()))
+            self.condition.notify()
+
+    def requeue(self, entries):
+        # Puts commands that were on the wire when the connection dropped back at the front of
+        # their queues in their original order. Field requests are dropped, the next one is due anyway.
+        with self.condition:
+            for entry in reversed(list(entries)):
+                if entry[1] == CommandClass.HOUSEKEEPING:
+                    self.deferred.appendleft(entry)
+                elif entry[1] == CommandClass.CONTROL:
+                    self.control.appendleft(entry)
+            self.condition.notify()
+
+    def setRegulating(self, regulating: bool):
+        with self.condition:
+            self.regulating = regulating
+            self.condition.notify()
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def setBaudRate(self, baud_rate: int):
+        self.char_time = 10 / baud_rate
+
+    def duration(self, command) -> float:
+        return (len(command.command) + command.blocksize) * self.char_time + self.turnaround
+
+    def next(self, block: bool = True) -> tuple:
+        # (command, CommandClass, time it was queued), or None if nothing should be sent yet and
+        # block is False. Blocking waits are bounded by the next field or housekeeping deadline.
+        with self.condition:
+            while True:
+                now = time.perf_counter()
+                if now >= self.next_info:
+                    pending = {type(entry[0]) for entry in self.deferred}
+                    for factory in self.housekeeping:
+                        # A query still waiting from last time covers this one
+                        if factory not in pending:
+                            self.deferred.append((factory(), CommandClass.HOUSEKEEPING, now))
+                    self.next_info = now + self.info_interval
+                if len(self.control) > 0:
+                    return self.take(self.control.popleft(), now)
+                if len(self.deferred) > 0:
+                    if not self.regulating:
+                        return self.take(self.deferred.popleft(), now)
+                    if now - self.deferred[0][2] >= self.max_defer:
+                        self.forced += 1
+                        return self.take(self.deferred.popleft(), now)
+                    if now + self.duration(self.deferred[0][0]) <= self.next_data:
+                        self.in_gap += 1
+                        return self.take(self.deferred.popleft(), now)
+                if now >= self.next_data:
+                    self.next_data = now + self.data_interval
+                    return (self.field_command, CommandClass.FIELD, now)
+                if not block:
+                    return None
+                wake = min(self.next_data, self.next_info)
+                if len(self.deferred) > 0 and self.regulating:
+                    wake = min(wake, self.deferred[0][2] + self.max_defer)
+                self.condition.wait(max(wake - now, 0.0))
+
+    def take(self, entry: tuple, now: float) -> tuple:
+        command_class = entry[1]
+        self.max_wait[command_class] = max(self.max_wait[command_class], now - entry[2])
+        return entry
+
+    def complete(self, command_class: CommandClass, enqueued: float, now: float):
+        # Called from the probe thread once the reply has been handled
+        self.latency[command_class].record(now - enqueued)
+        if command_class == CommandClass.FIELD:
+            if self.last_field is not None:
+                self.field_gaps.record(now - self.last_field)
+            self.last_field = now
+
+    def summary(self) -> dict:
+        summary = {}
+        for command_class in CommandClass:
+            histogram = self.latency[command_class]
+            summary[command_class.value] = {
+                'count': histogram.count,
+                'p50': histogram.percentile(50.0),
+                'p99': histogram.percentile(99.0),
+                'max_wait': self.max_wait[command_class],
+            }
+        summary['field_gap_p99'] = self.field_gaps.percentile(99.0)
+        summary['field_gap_max'] = self.field_gaps.percentile(100.0)
+        summary['housekeeping_in_gap'] = self.in_gap
+        summary['housekeeping_forced'] = self.forced
+        summary['housekeeping_pending'] = len(self.deferred)
+        return summary
@@ -0,0 +1,130 @@
+import numpy as np
+
+# Columns of a sample row
+TIME = 0
+X = 1
+Y = 2
+Z = 3
+COMPOSITE = 4
+COLUMNS = 5
+
+
+class SampleRingBuffer():
+    # Fixed capacity store of (perf_counter time, x, y, z, composite) probe samples. There is one
+    # writer, the probe thread, and it publishes a row by bumping count after the row is written,
+    # so readers never need a lock.
+    #
+    # Every row is written twice, at i and i + capacity, so the newest n <= capacity rows are
+    # always one contiguous slice and every read is a view instead of a copy. A view is only
+    # stable until the writer wraps around onto it, so take a copy if it has to outlive roughly
+    # capacity - n more samples.
+    #
+    # count is the sequence number of the next sample and only ever grows, clear() included, so a
+    # since() reader never replays or skips samples across a clear.
+
+    def __init__(self, capacity: int = 65536):
+        self.capacity = capacity
+        self.data = np.zeros((2 * capacity, COLUMNS), dtype=np.float64)
+        self.count = 0
+        # Sequence of the oldest sample still valid, moved up by clear()
+        self.start = 0
+
+    def __len__(self) -> int:
+        return min(self.count - self.start, self.capacity)
+
+    def append(self, timestamp: float, x: float, y: float, z: float, composite: float):
+        index = self.count % self.capacity
+        row = self.data[index]
+        row[TIME] = timestamp
+        row[X] = x
+        row[Y] = y
+        row[Z] = z
+        row[COMPOSITE] = composite
+        self.data[index + self.capacity] = row
+        self.count += 1
+
+    def extend(self, rows: np.ndarray):
+        # Appends a block of rows with at most two slice copies per half
+        skipped = max(len(rows) - self.capacity, 0)
+        rows = rows[skipped:]
+        n = len(rows)
+        if n == 0:
+            return
+        start = (self.count + skipped) % self.capacity
+        first = min(n, self.capacity - start)
+        self.data[start:start + first] = rows[:first]
+        self.data[start + self.capacity:start + self.capacity + first] = rows[:first]
+        if first < n:
+            self.data[:n - first] = rows[first:]
+            self.data[self.capacity:self.capacity + n - first] = rows[first:]
+        self.count += skipped + n
+
+    def clear(self):
+        # Writer side only. Drops everything held so far, the sequence carries on from here.
+        self.start = self.count
+
+    def last(self, n: int) -> np.ndarray:
+        # Newest n samples, oldest first
+        count = self.count
+        n = min(n, count - self.start, self.capacity)
+        start = (count - n) % self.capacity
+        return self.data[start:start + n]
+
+    def latest(self) -> np.ndarray:
+        # Newest sample as a row view, None before the first one
+        if self.count == self.start:
+            return None
+        return self.data[(self.count - 1) % self.capacity]
+
+    def since(self, sequence: int) -> tuple[np.ndarray, int]:
+        # Samples appended after sequence, and the sequence to pass next time. Readers that fall
+        # more than capacity behind silently lose the oldest samples.
+        count = self.count
+        # A sequence from before a clear() starts at the first sample after it
+        sequence = min(max(sequence, self.start), count)
+        return self.last(count - sequence), count
+
+    def after(self, timestamp: float) -> np.ndarray:
+        # Retained samples newer than timestamp
+        samples = self.last(self.capacity)
+        return samples[np.searchsorted(samples[:, TIME], timestamp, side='right'):]
+
+    def at(self, timestamp: float, search: int = 64) -> np.ndarray:
+        # Sample linearly interpolated at timestamp, None outside the retained samples. The newest
+        # search samples are tried first, which covers anything close to real time.
+        samples = self.last(search)
+        if len(samples) == 0 or timestamp > samples[-1, TIME]:
+            return None
+        if timestamp < samples[0, TIME]:
+            samples = self.last(self.capacity)
+            if timestamp < samples[0, TIME]:
+                return None
+        index = np.searchsorted(samples[:, TIME], timestamp, side='left')
+        after = samples[index]
+        if index == 0 or after[TIME] == timestamp:
+            return after.copy()
+        before = samples[index - 1]
+        fraction = (timestamp - before[TIME]) / (after[TIME] - before[TIME])
+        return before + (after - before) * fraction
+
+    def window(self, seconds: float) -> np.ndarray:
+        # Samples from the last seconds, measured from the newest sample
+        latest = self.latest()
+        if latest is None:
+            return self.last(0)
+        return self.after(latest[TIME] - seconds)
+
+    def statistics(self, seconds: float) -> dict:
+        samples = self.window(seconds)
+        if len(samples) == 0:
+            return {'count': 0}
+        composite = samples[:, COMPOSITE]
+        span = samples[-1, TIME] - samples[0, TIME]
+        return {
+            'count': len(samples),
+            'rate': float((len(samples) - 1) / span) if span > 0 else 0.0,
+            'mean': float(composite.mean()),
+            'std': float(composite.std()),
+            'min': float(composite.min()),
+            'max': float(composite.max()),
+        }
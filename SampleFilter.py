@@ -0,0 +1,171 @@
+import math
+import numpy as np
+from abc import ABC, abstractmethod
+from numpy.lib.stride_tricks import sliding_window_view
+from SampleBuffer import SampleRingBuffer, TIME
+
+
+class FilterStage(ABC):
+    # Works on a block of (time, x, y, z, composite) rows at a time and carries whatever state it
+    # needs across blocks, so a block of one row gives the same result as the same rows in bulk.
+
+    @abstractmethod
+    def process(self, block: np.ndarray) -> np.ndarray:
+        pass
+
+    def reset(self):
+        pass
+
+
+class WindowStage(FilterStage):
+    # Base for stages that look at the last window samples of each column
+
+    def __init__(self, window: int):
+        self.window = window
+        self.history = None
+
+    def reset(self):
+        self.history = None
+
+    def windows(self, values: np.ndarray) -> np.ndarray:
+        # (rows, columns, window) view, the first samples are padded with the very first value
+        if self.history is None:
+            self.history = np.repeat(values[:1], self.window - 1, axis=0)
+        extended = np.concatenate((self.history, values))
+        self.history = self.tail(extended)
+        return sliding_window_view(extended, self.window, axis=0)
+
+    def tail(self, values: np.ndarray) -> np.ndarray:
+        return values[len(values) - (self.window - 1):]
+
+
+class MovingAverage(WindowStage):
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        if len(block) == 0:
+            return block
+        output = block.copy()
+        output[:, TIME + 1:] = self.windows(block[:, TIME + 1:]).mean(axis=-1)
+        return output
+
+
+class Median(WindowStage):
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        if len(block) == 0:
+            return block
+        output = block.copy()
+        output[:, TIME + 1:] = np.median(self.windows(block[:, TIME + 1:]), axis=-1)
+        return output
+
+
+class OutlierRejection(WindowStage):
+    # Hampel filter over the trailing window of raw values: a value further than threshold scaled
+    # MADs from the window median is replaced by the median. min_deviation keeps a flat, quantised signal from
+    # turning every step of one count into an outlier.
+
+    def __init__(self, window: int = 7, threshold: float = 3.0, min_deviation: float = 0.05):
+        super().__init__(window)
+        self.threshold = threshold
+        self.min_deviation = min_deviation
+        self.rejected = 0
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        if len(block) == 0:
+            return block
+        values = block[:, TIME + 1:]
+        windows = self.windows(values)
+        median = np.median(windows, axis=-1)
+        mad = np.median(np.abs(windows - median[..., None]), axis=-1)
+        limit = self.threshold * np.maximum(1.4826 * mad, self.min_deviation)
+        outliers = np.abs(values - median) > limit
+        self.rejected += int(outliers.sum())
+        output = block.copy()
+        output[:, TIME + 1:] = np.where(outliers, median, values)
+        return output
+
+    def reset(self):
+        super().reset()
+        self.rejected = 0
+
+
+class ExponentialAverage(FilterStage):
+    # y[i] = y[i-1] + alpha * (x[i] - y[i-1]) in closed form over the block
+
+    def __init__(self, alpha: float = 0.2, chunk: int = 256):
+        self.alpha = alpha
+        # Longest run in closed form, shortened for large alpha so decay ** -chunk stays in range
+        self.chunk = chunk
+        self.state = None
+
+    def reset(self):
+        self.state = None
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        if len(block) == 0:
+            return block
+        output = block.copy()
+        if self.state is None:
+            self.state = block[0, TIME + 1:].copy()
+        decay = 1.0 - self.alpha
+        if decay <= 0.0:
+            # No memory, every row is its own average
+            self.state = block[-1, TIME + 1:].copy()
+            return output
+        chunk = self.chunk
+        if decay < 1.0:
+            # Keeps decay ** -chunk under 1e150, which leaves the values plenty of headroom
+            chunk = max(1, min(chunk, int(150.0 / -math.log10(decay))))
+        for start in range(0, len(block), chunk):
+            values = block[start:start + chunk, TIME + 1:]
+            powers = decay ** np.arange(1, len(values) + 1)[:, None]
+            weighted = np.cumsum(values / powers, axis=0) * self.alpha
+            smoothed = powers * (self.state + weighted)
+            output[start:start + len(values), TIME + 1:] = smoothed
+            self.state = smoothed[-1].copy()
+        return output
+
+
+class Decimate(FilterStage):
+    # Keeps every factor-th row, put an average in front of it to avoid aliasing
+
+    def __init__(self, factor: int):
+        self.factor = factor
+        self.phase = 0
+
+    def reset(self):
+        self.phase = 0
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        first = (-self.phase) % self.factor
+        self.phase = (self.phase + len(block)) % self.factor
+        return block[first::self.factor]
+
+
+class SampleStream():
+    # A consumer's filtered view of a probe's SampleRingBuffer. Each call to update() takes every
+    # raw sample since the last call and runs the stages over them as one block, so a consumer
+    # that updates at 10 Hz does the work of ten blocks a second whatever the probe rate is.
+    # update() and reset() belong to the one consumer that owns the stream.
+
+    def __init__(self, source: SampleRingBuffer, stages: list = (), capacity: int = 16384):
+        self.source = source
+        self.stages = list(stages)
+        self.output = SampleRingBuffer(capacity)
+        self.sequence = source.count
+
+    def update(self) -> np.ndarray:
+        block, self.sequence = self.source.since(self.sequence)
+        for stage in self.stages:
+            block = stage.process(block)
+        self.output.extend(block)
+        return block
+
+    def latest(self) -> np.ndarray:
+        return self.output.latest()
+
+    def reset(self):
+        # Starts over from the newest raw sample
+        self.sequence = self.source.count
+        for stage in self.stages:
+            stage.reset()
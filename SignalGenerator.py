@@ -5,6 +5,15 @@ import threading
 import queue
 import ping3
 import math
+import concurrent.futures
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+from CommandQueue import CoalescingQueue
+from AsyncSCPI import AsyncSocketInstrument, AsyncSockInstError
+from LatencyStats import CommandLatencyStats, LatencyStage
+from SweepScheduler import DeadlineScheduler
+from SampleBuffer import SampleRingBuffer, TIME, COMPOSITE
 from PyQt5.QtCore import QObject, pyqtSignal
 from enum import Enum
 
@@ -19,6 +28,11 @@ class Sweep(Enum):
     LINEAR = 1
     EXPONENTIAL = 2
     
+class SweepMode(Enum):
+    SOFTWARE = 0
+    LIST = 1
+    STEP = 2
+    
 class Frequency(Enum):
     Hz = 'Hz'
     kHz = 'kHz'
@@ -30,6 +44,14 @@ class Time(Enum):
     Millisecond = 'ms'
     Second = 'sec'
     
+class Transport(Enum):
+    ACKNOWLEDGED = 0
+    PIPELINED = 1
+    
+class Backend(Enum):
+    SOCKET = 0
+    ASYNCIO = 1
+    
 class SCPI(Enum):
     On = 'ON'
     Off = 'OFF'
@@ -39,10 +61,15 @@ class SCPI(Enum):
     High = 'HIGH'
     Linear = 'LIN'
     Exponential = 'EXP'
+    Logarithmic = 'LOG'
     Internal = 'INT'
     External = 'EXT'
     AC = 'AC'
     DC = 'DC'
+    List = 'LIST'
+    Fixed = 'FIX'
+    Step = 'STEP'
+    Immediate = 'IMM'
     RFOut = ':OUTP:STAT'
     Identity = '*IDN'
     Frequency = ':FREQ'
@@ -69,10 +96,59 @@ class SCPI(Enum):
     PMFreq = ':PM:INT:FREQ'
     PMStep = ':PM:INT:FREQ:STEP'
     ModulationState = ':OUTP:MOD:STAT'
+    ListType = ':LIST:TYPE'
+    ListFrequency = ':LIST:FREQ'
+    ListPower = ':LIST:POW'
+    ListPoints = ':LIST:FREQ:POIN'
+    ListDwellType = ':LIST:DWEL:TYPE'
+    ListTrigger = ':LIST:TRIG:SOUR'
+    SweepDwell = ':SWE:DWEL'
+    SweepPoints = ':SWE:POIN'
+    SweepSpacing = ':SWE:SPAC'
+    FrequencyStart = ':FREQ:STAR'
+    FrequencyStop = ':FREQ:STOP'
+    SweepPoint = ':SWE:CPO'
+    FrequencyMode = ':FREQ:MODE'
+    PowerMode = ':POW:MODE'
+    InitiateContinuous = ':INIT:CONT'
+    Initiate = ':INIT'
+    Abort = ':ABOR'
+    Reset = '*RST'
     OperationComplete = '*OPC?'
+    EventStatus = '*ESR?'
+    SystemError = ':SYST:ERR?'
     Empty = ''
+    Transaction = 'Transaction'
     Exit = 'Exit'
 
+# Scale from a commanded frequency unit to the Hz the instrument reports back
+FREQUENCY_SCALE = {
+    Frequency.Hz.value: 1.0,
+    Frequency.kHz.value: 1000.0,
+    Frequency.MHz.value: 1000000.0,
+    Frequency.GHz.value: 1000000000.0,
+}
+
+# *ESR? bits for query, device dependent, execution and command errors
+ESR_ERROR_MASK = 0x3C
+
+# Commands whose result can't be known without asking the instrument
+READBACK_COMMANDS = {SCPI.Identity, SCPI.ListPoints, SCPI.SweepPoints, SCPI.SweepPoint}
+
+# Commands with no query form, these are written without *OPC? or readback
+WRITE_ONLY_COMMANDS = {SCPI.Initiate, SCPI.Abort, SCPI.Reset}
+
+# Plain settings the driver shadows, a write matching the last confirmed value is skipped
+SHADOWED_COMMANDS = {
+    SCPI.RFOut, SCPI.Frequency, SCPI.Power, SCPI.ModulationState,
+    SCPI.AMState, SCPI.AMType, SCPI.AMMode, SCPI.AMSource, SCPI.AMCoupling, SCPI.AMFreq, SCPI.AMLinDepth, SCPI.AMExpDepth,
+    SCPI.FMState, SCPI.FMSource, SCPI.FMCoupling, SCPI.FMFreq, SCPI.FMStep,
+    SCPI.PMState, SCPI.PMSource, SCPI.PMBand, SCPI.PMCoupling, SCPI.PMFreq, SCPI.PMStep,
+}
+
+# List sweep table size on the N5181A
+MAX_LIST_POINTS = 1601
+
 class SignalGenerator(QObject):
     instrumentConnected = pyqtSignal(str)
     instrumentDetected = pyqtSignal(bool)
@@ -220,6 +296,22 @@ class SignalGenerator(QObject):
     def clearErrors(self):
         pass
     
+    def setTransport(self, pipelined: bool):
+        pass
+    
+    def setBackend(self, backend: Backend):
+        pass
+    
+    def resetInstrument(self):
+        pass
+    
+    @contextmanager
+    def transaction(self):
+        yield self
+    
+    def setSweepMode(self, mode: SweepMode):
+        pass
+    
     def setSweepType(self, exp: bool):
         if exp:
             self.sweepType = Sweep.EXPONENTIAL
@@ -302,8 +394,13 @@ class AgilentN5181A(QObject):
     rfOutSet = pyqtSignal(bool)
     sweepFinished = pyqtSignal()
     sweepStatus = pyqtSignal(float)
+    latencyStats = pyqtSignal(dict)
+    sweepTiming = pyqtSignal(dict)
+    configurationApplied = pyqtSignal(dict)
+    # Frequencies in Hz and 20 log10(V/m) - dBm at each, NaN where the probe had no reading
+    characterisationFinished = pyqtSignal(object, object)
     
-    def __init__(self, ip_address: str = '192.168.100.79',  port: int = 5024):
+    def __init__(self, ip_address: str = '192.168.100.79',  port: int = 5025):
         super().__init__()
         self.ip_address = ip_address
         self.port = port
@@ -311,9 +408,14 @@ class AgilentN5181A(QObject):
         self.is_running = False
         self.power = 0.0
         self.frequency = 0.0
-        self.commandQueue = queue.Queue()
+        # A newer frequency or power replaces one the instrument hasn't taken yet
+        self.commandQueue = CoalescingQueue({SCPI.Frequency, SCPI.Power, SCPI.SweepPoints, SCPI.SweepPoint})
         self.write_thread = None
+        self.ping_thread = None
+        self.sweepThread = None
         self.runSweep = False
+        self.sweepStopEvent = threading.Event()
+        self.backend = Backend.SOCKET
         self.commandLock = threading.Lock()
         self.sweepType = Sweep.OFF
         self.startFrequency = 100.0
@@ -323,6 +425,40 @@ class AgilentN5181A(QObject):
         self.clearing = False
         self.detected = False
         self.sweepTerm = 0.005
+        self.transport = Transport.ACKNOWLEDGED
+        self.syncInterval = 32
+        self.syncPeriod = 0.25
+        self.unconfirmed = {}
+        self.unconfirmedCount = 0
+        self.unconfirmedWrites = []
+        self.lastSync = time.perf_counter()
+        # Rolling latency per command and stage, published on latencyStats every statsInterval seconds
+        # as a raw snapshot, CommandLatencyStats.summarise() turns it into percentiles on the receiving side
+        self.commandStats = CommandLatencyStats()
+        self.statsInterval = 1.0
+        self.lastStatsEmit = time.perf_counter()
+        # Last confirmed (command, readback) per shadowed setting
+        self.shadowState = {}
+        self.shadowHits = 0
+        self.shadowMisses = 0
+        # Settings collected by an open transaction(), per calling thread
+        self.transactionLocal = threading.local()
+        self.sweepMode = SweepMode.SOFTWARE
+        self.sweepFrequencies = []
+        self.sweepPowers = None
+        self.sweepPoint = -1
+        self.sweepPollInterval = 0.1
+        # From just before the last point is due, so the sweep hands back soon after it ends
+        self.sweepEndPollInterval = 0.01
+        # Seconds past the expected sweep time, or a quarter of it if that is longer, before a list
+        # or step sweep that never reached its last point is given up on
+        self.sweepTimeoutMargin = 1.0
+        # Software sweeps spin for the last spinThreshold seconds before each step deadline
+        self.spinThreshold = 0.002
+        self.sweepScheduler = None
+        # Step sweep settings as reported by the instrument, None until read back
+        self.instrumentStepCount = None
+        self.instrumentDwell = None
     
     def detect(self):
         print('Detecting.')
@@ -341,24 +477,65 @@ class AgilentN5181A(QObject):
         self.ping_thread.join()
 
     def stop(self):
-        self.commandQueue.put((SCPI.Exit, f'{SCPI.RFOut.value} {SCPI.Off.value}'))
-        self.is_running = False
         self.ping_started = False
         if self.ping_thread is not None and self.ping_thread.is_alive():
             self.ping_thread.join()
+        self.closeConnection()
+        
+    def closeConnection(self):
+        self.is_running = False
+        self.commandQueue.put((SCPI.Exit, f'{SCPI.RFOut.value} {SCPI.Off.value}'))
+        if self.backend == Backend.ASYNCIO and self.instrument is not None:
+            # Release a read blocked on the instrument instead of waiting out its timeout
+            self.instrument.cancel()
         if self.write_thread is not None and self.write_thread.is_alive():
             self.write_thread.join()
+        # Anything still queued is kept for the next connection
+        self.commandQueue.discard(SCPI.Exit)
+        if self.instrument is not None:
+            try:
+                self.instrument.close()
+            except OSError as e:
+                print(f'Error on close: {str(e)}')
+            self.instrument = None
+            
+    def reconnect(self):
+        self.closeConnection()
+        self.connect()
+        
+    def invalidateShadowState(self, *commandTypes: SCPI):
+        # No arguments forgets everything
+        if len(commandTypes) == 0:
+            self.shadowState.clear()
+        for commandType in commandTypes:
+            self.shadowState.pop(commandType, None)
+            
+    def getShadowCacheStats(self) -> dict:
+        return {'hits': self.shadowHits, 'misses': self.shadowMisses, 'entries': len(self.shadowState)}
+    
+    def resetShadowCacheStats(self):
+        self.shadowHits = 0
+        self.shadowMisses = 0
+        
+    def setBackend(self, backend: Backend):
+        # Takes effect on the next connect()
+        self.backend = backend
         
     def connect(self):
+        # Whatever the instrument holds now is unknown until confirmed again
+        self.invalidateShadowState()
         try:
-            self.instrument = socketscpi.SocketInstrument(self.ip_address)
+            if self.backend == Backend.ASYNCIO:
+                self.instrument = AsyncSocketInstrument(self.ip_address, self.port)
+            else:
+                self.instrument = socketscpi.SocketInstrument(self.ip_address, self.port)
             self.instrumentConnected.emit(self.instrument.instId)
             #print(f'Connected To: {self.instrument.instId}')
             self.write_thread = threading.Thread(target=self.writeSCPI)
             self.is_running = True
             self.clearing = False
             self.write_thread.start()
-        except socketscpi.SockInstError as e:
+        except (socketscpi.SockInstError, AsyncSockInstError) as e:
             self.error.emit(str(e))
             print(f'Error on connect: {str(e)}')
             self.is_running = False
@@ -376,6 +553,37 @@ class AgilentN5181A(QObject):
     
     def initInstrument(self):
         self.commandQueue.put((SCPI.Identity, ''))
+        
+    def resetInstrument(self):
+        self.commandQueue.put((SCPI.Reset, SCPI.Reset.value))
+        
+    def queueCommand(self, command: tuple):
+        commands = getattr(self.transactionLocal, 'commands', None)
+        if commands is not None and command[0] in SHADOWED_COMMANDS:
+            # Last call per setting wins, like the coalescing queue
+            commands.pop(command[0], None)
+            commands[command[0]] = command[1]
+        else:
+            self.commandQueue.put(command)
+            
+    @contextmanager
+    def transaction(self):
+        # Setter calls inside the block go out as one message and are verified with one query,
+        # reported through configurationApplied instead of the per-setting signals
+        if getattr(self.transactionLocal, 'commands', None) is not None:
+            # Nested, the outer transaction sends everything
+            yield self
+            return
+        self.transactionLocal.commands = OrderedDict()
+        try:
+            yield self
+            commands = self.transactionLocal.commands
+        finally:
+            self.transactionLocal.commands = None
+        if len(commands) > 0:
+            # The (setting, command) pairs go through as collected, a header doesn't always name
+            # the setting it was queued under
+            self.commandQueue.put((SCPI.Transaction, list(commands.items())))
     
     #def setFrequency(self, freq: float):
         # Assume MHz
@@ -397,49 +605,49 @@ class AgilentN5181A(QObject):
                 freq = 6000000.0
             if freq < 100.0:
                 freq = 100.0
-        self.commandQueue.put((SCPI.Frequency, f'{SCPI.Frequency.value} {str(freq)} {unit}'))
+        self.queueCommand((SCPI.Frequency, f'{SCPI.Frequency.value} {str(freq)} {unit}'))
         
     def setPower(self, pow: float):
         if pow > 15.0:
             pow = 15.0
             self.error.emit("Power above amplifier maximum input. Setting to 0.0 dBm")
-        self.commandQueue.put((SCPI.Power, f'{SCPI.Power.value} {str(round(pow, 3))} {SCPI.dBm.value}'))
+        self.queueCommand((SCPI.Power, f'{SCPI.Power.value} {str(round(pow, 3))} {SCPI.dBm.value}'))
     
     def setModulationType(self, mod):
         if mod == Modulation.AM:
-            self.commandQueue.put((SCPI.PMState, f'{SCPI.PMState.value} {SCPI.Off.value}'))
-            self.commandQueue.put((SCPI.FMState, f'{SCPI.FMState.value} {SCPI.Off.value}'))
-            self.commandQueue.put((SCPI.AMState, f'{SCPI.AMState.value} {SCPI.On.value}'))
+            self.queueCommand((SCPI.PMState, f'{SCPI.PMState.value} {SCPI.Off.value}'))
+            self.queueCommand((SCPI.FMState, f'{SCPI.FMState.value} {SCPI.Off.value}'))
+            self.queueCommand((SCPI.AMState, f'{SCPI.AMState.value} {SCPI.On.value}'))
         elif mod == Modulation.FM:
-            self.commandQueue.put((SCPI.PMState, f'{SCPI.PMState.value} {SCPI.Off.value}'))
-            self.commandQueue.put((SCPI.AMState, f'{SCPI.AMState.value} {SCPI.Off.value}'))
-            self.commandQueue.put((SCPI.FMState, f'{SCPI.FMState.value} {SCPI.On.value}'))
+            self.queueCommand((SCPI.PMState, f'{SCPI.PMState.value} {SCPI.Off.value}'))
+            self.queueCommand((SCPI.AMState, f'{SCPI.AMState.value} {SCPI.Off.value}'))
+            self.queueCommand((SCPI.FMState, f'{SCPI.FMState.value} {SCPI.On.value}'))
         elif mod == Modulation.PM:
-            self.commandQueue.put((SCPI.FMState, f'{SCPI.FMState.value} {SCPI.Off.value}'))
-            self.commandQueue.put((SCPI.AMState, f'{SCPI.AMState.value} {SCPI.Off.value}'))
-            self.commandQueue.put((SCPI.PMState, f'{SCPI.PMState.value} {SCPI.On.value}'))
+            self.queueCommand((SCPI.FMState, f'{SCPI.FMState.value} {SCPI.Off.value}'))
+            self.queueCommand((SCPI.AMState, f'{SCPI.AMState.value} {SCPI.Off.value}'))
+            self.queueCommand((SCPI.PMState, f'{SCPI.PMState.value} {SCPI.On.value}'))
     
     # TODO: Ranges, coupling, normal/deep/high
     def setModulationState(self, on: bool):
-        self.commandQueue.put((SCPI.ModulationState, f'{SCPI.ModulationState.value} {SCPI.On.value if on else SCPI.Off.value}'))
+        self.queueCommand((SCPI.ModulationState, f'{SCPI.ModulationState.value} {SCPI.On.value if on else SCPI.Off.value}'))
     
     def setAMSource(self, internal: bool):
-        self.commandQueue.put((SCPI.AMSource, f'{SCPI.AMSource.value} {SCPI.Internal.value if internal else SCPI.External.value}'))
+        self.queueCommand((SCPI.AMSource, f'{SCPI.AMSource.value} {SCPI.Internal.value if internal else SCPI.External.value}'))
         
     def setAMMode(self, normal: bool):
-        self.commandQueue.put((SCPI.AMSource, f'{SCPI.AMMode.value} {SCPI.Normal.value if normal else SCPI.Deep.value}'))
+        self.queueCommand((SCPI.AMMode, f'{SCPI.AMMode.value} {SCPI.Normal.value if normal else SCPI.Deep.value}'))
     
     def setAMCoupling(self, dc: bool):
-        self.commandQueue.put((SCPI.AMCoupling, f'{SCPI.AMCoupling.value} {SCPI.DC.value if dc else SCPI.AC.value}'))
+        self.queueCommand((SCPI.AMCoupling, f'{SCPI.AMCoupling.value} {SCPI.DC.value if dc else SCPI.AC.value}'))
 
     def setAMType(self, linear: bool):
-        self.commandQueue.put((SCPI.AMType, f'{SCPI.AMType.value} {SCPI.Linear.value if linear else SCPI.Exponential.value}'))
+        self.queueCommand((SCPI.AMType, f'{SCPI.AMType.value} {SCPI.Linear.value if linear else SCPI.Exponential.value}'))
     
     def setAMLinearDepth(self, percent: float):
-        self.commandQueue.put((SCPI.AMLinDepth, f'{SCPI.AMLinDepth.value} {str(percent)}'))
+        self.queueCommand((SCPI.AMLinDepth, f'{SCPI.AMLinDepth.value} {str(percent)}'))
         
     def setAMExpDepth(self, depth: float):
-        self.commandQueue.put((SCPI.AMExpDepth, f'{SCPI.AMExpDepth.value} {str(depth)}'))
+        self.queueCommand((SCPI.AMExpDepth, f'{SCPI.AMExpDepth.value} {str(depth)}'))
         
     def setAMFrequency(self, freq: float):
         # Range: 0.1 -> 20 MHz
@@ -447,16 +655,16 @@ class AgilentN5181A(QObject):
             freq = 20000
         if freq < 0.0001:
             freq = 0.0001
-        self.commandQueue.put((SCPI.AMFreq, f'{SCPI.AMFreq.value} {str(freq)} {Frequency.kHz.value}'))
+        self.queueCommand((SCPI.AMFreq, f'{SCPI.AMFreq.value} {str(freq)} {Frequency.kHz.value}'))
         
     def setAMState(self, on: bool):
-        self.commandQueue.put((SCPI.AMState, f'{SCPI.AMState.value} {SCPI.On.value if on else SCPI.Off.value}'))
+        self.queueCommand((SCPI.AMState, f'{SCPI.AMState.value} {SCPI.On.value if on else SCPI.Off.value}'))
         
     def setFMState(self, on: bool):
-        self.commandQueue.put((SCPI.FMState, f'{SCPI.FMState.value} {SCPI.On.value if on else SCPI.Off.value}'))
+        self.queueCommand((SCPI.FMState, f'{SCPI.FMState.value} {SCPI.On.value if on else SCPI.Off.value}'))
     
     def setFMSource(self, internal: bool):
-        self.commandQueue.put((SCPI.FMSource, f'{SCPI.FMSource.value} {SCPI.Internal.value if internal else SCPI.External.value}'))
+        self.queueCommand((SCPI.FMSource, f'{SCPI.FMSource.value} {SCPI.Internal.value if internal else SCPI.External.value}'))
 
     def setFMFrequency(self, freq: float, unit: str = Frequency.kHz.value):
         # Range: 0.1 Hz -> 2MHz
@@ -472,20 +680,20 @@ class AgilentN5181A(QObject):
         else:
             unit = Frequency.kHz.value
             freq = 1
-        self.commandQueue.put((SCPI.FMFreq, f'{SCPI.FMFreq.value} {str(freq)} {unit}'))
+        self.queueCommand((SCPI.FMFreq, f'{SCPI.FMFreq.value} {str(freq)} {unit}'))
         
     def setFMStep(self, step: float):
         # Range: 0.5Hz - 1e6 Hz
-        self.commandQueue.put((SCPI.FMStep, f'{SCPI.FMStep.value} {str(step)}'))
+        self.queueCommand((SCPI.FMStep, f'{SCPI.FMStep.value} {str(step)}'))
     
     def setFMCoupling(self, dc: bool):
-        self.commandQueue.put((SCPI.FMCoupling, f'{SCPI.FMCoupling.value} {SCPI.DC.value if dc else SCPI.AC.value}'))
+        self.queueCommand((SCPI.FMCoupling, f'{SCPI.FMCoupling.value} {SCPI.DC.value if dc else SCPI.AC.value}'))
         
     def setPMState(self, on: bool):
-        self.commandQueue.put((SCPI.PMState, f'{SCPI.PMState.value} {SCPI.On.value if on else SCPI.Off.value}'))
+        self.queueCommand((SCPI.PMState, f'{SCPI.PMState.value} {SCPI.On.value if on else SCPI.Off.value}'))
     
     def setPMSource(self, internal: bool):
-        self.commandQueue.put((SCPI.PMSource, f'{SCPI.PMSource.value} {SCPI.Internal.value if internal else SCPI.External.value}'))
+        self.queueCommand((SCPI.PMSource, f'{SCPI.PMSource.value} {SCPI.Internal.value if internal else SCPI.External.value}'))
  
     def setPMFrequency(self, freq: float, unit: str = Frequency.kHz.value):
         # Range: 0.1 Hz -> 2MHz
@@ -498,26 +706,37 @@ class AgilentN5181A(QObject):
         else:
             unit = Frequency.kHz.value
             freq = 1
-        self.commandQueue.put((SCPI.PMFreq, f'{SCPI.PMFreq.value} {str(freq)} {unit}'))
+        self.queueCommand((SCPI.PMFreq, f'{SCPI.PMFreq.value} {str(freq)} {unit}'))
         
     def setPMStep(self, step: float):
         # Range: 0.5Hz - 1e6 Hz
-        self.commandQueue.put((SCPI.PMStep, f'{SCPI.PMFreq.value} {str(step)}'))
+        self.queueCommand((SCPI.PMStep, f'{SCPI.PMFreq.value} {str(step)}'))
     
     def setPMCoupling(self, dc: bool):
-        self.commandQueue.put((SCPI.PMCoupling, f'{SCPI.PMCoupling.value} {SCPI.DC.value if dc else SCPI.AC.value}'))    
+        self.queueCommand((SCPI.PMCoupling, f'{SCPI.PMCoupling.value} {SCPI.DC.value if dc else SCPI.AC.value}'))    
     
     def setPMBandwidth(self, normal: bool):
-        self.commandQueue.put((SCPI.PMBand, f'{SCPI.PMBand.value} {SCPI.Normal.value if normal else SCPI.High.value}'))
+        self.queueCommand((SCPI.PMBand, f'{SCPI.PMBand.value} {SCPI.Normal.value if normal else SCPI.High.value}'))
     
     def setRFOut(self, on: bool):
         #self.clearQueue()
-        self.commandQueue.put((SCPI.RFOut, f'{SCPI.RFOut.value} {SCPI.On.value if on else SCPI.Off.value}'))
+        self.queueCommand((SCPI.RFOut, f'{SCPI.RFOut.value} {SCPI.On.value if on else SCPI.Off.value}'))
         
     def clearQueue(self):
-        self.clearing = True
-        while self.commandQueue.qsize() != 0:
-            self.commandQueue.get()
+        self.commandQueue.clear()
+        
+    def getQueueDepth(self) -> int:
+        return self.commandQueue.qsize()
+    
+    def getPeakQueueDepth(self) -> int:
+        return self.commandQueue.peak_depth
+    
+    def getDroppedCommandCount(self) -> int:
+        # Stale frequency/power writes replaced before reaching the instrument
+        return self.commandQueue.dropped
+    
+    def resetQueueCounters(self):
+        self.commandQueue.resetCounters()
 
     def clearErrors(self):
         try:
@@ -525,16 +744,30 @@ class AgilentN5181A(QObject):
         except socketscpi.SockInstError as e:
             print(e)
             #self.error_occured.emit(e)
+            
+    def setTransport(self, pipelined: bool):
+        # Pipelined streams writes and confirms them every syncInterval commands or syncPeriod seconds
+        self.transport = Transport.PIPELINED if pipelined else Transport.ACKNOWLEDGED
 
     def setSweepType(self, exp: bool):
         if exp:
             self.sweepType = Sweep.EXPONENTIAL
         else:
             self.sweepType = Sweep.LINEAR
+        self.updateStepSweep()
+            
+    def setSweepMode(self, mode: SweepMode):
+        self.sweepMode = mode
+        self.updateStepSweep()
+        
+    def setSweepPowers(self, powers: list):
+        # Optional dBm per list point, None keeps the current fixed power
+        self.sweepPowers = powers
             
     def setStartFrequency(self, freq: float):
         # Convert to kHz
         self.startFrequency = freq * 1000
+        self.updateStepSweep()
         
     def getStartFrequency(self) -> float:
         # Convert back to MHz
@@ -543,6 +776,7 @@ class AgilentN5181A(QObject):
     def setStopFrequency(self, freq: float):
         # Convert to kHz
         self.stopFrequency = freq * 1000
+        self.updateStepSweep()
         
     def getStopFrequency(self) -> float:
         # Convert back to MHz
@@ -561,37 +795,143 @@ class AgilentN5181A(QObject):
         elif unit == Time.Millisecond.value:
             dwell *= 0.001
         self.stepDwell = dwell
+        self.updateStepSweep()
         
     def setSweepTerm(self, term: float):
         self.sweepTerm = term
+        self.updateStepSweep()
     
     def getStepCount(self) -> int:
+        if self.sweepMode == SweepMode.STEP and self.instrumentStepCount is not None:
+            return self.instrumentStepCount
         steps = math.log(self.stopFrequency / self.startFrequency) / math.log(1.0 + self.sweepTerm)
         self.stepCount = int(math.ceil(steps))
         return self.stepCount
     
     def getSweepTime(self) -> float:
+        if self.sweepMode == SweepMode.STEP and self.instrumentStepCount is not None and self.instrumentDwell is not None:
+            return self.instrumentDwell * self.instrumentStepCount
         return self.stepDwell * self.getStepCount()
     
+    def getSweepFrequencies(self) -> list:
+        # Same points sweepExponential steps through, in kHz
+        frequencies = []
+        current = self.startFrequency
+        while current <= self.stopFrequency:
+            frequencies.append(current)
+            current = current + (current * self.sweepTerm)
+        return frequencies
+    
+    def getStepSweepFrequencies(self, points: int) -> list:
+        # Points the instrument visits for a step sweep, in kHz
+        if points < 2:
+            return [self.startFrequency]
+        if self.sweepType == Sweep.LINEAR:
+            step = (self.stopFrequency - self.startFrequency) / (points - 1)
+            return [self.startFrequency + step * i for i in range(points)]
+        ratio = self.stopFrequency / self.startFrequency
+        return [self.startFrequency * pow(ratio, i / (points - 1)) for i in range(points)]
+    
+    def updateStepSweep(self):
+        # Keep the instrument's step sweep matching the UI so the getters report real values
+        if self.sweepMode != SweepMode.STEP or not self.is_running:
+            return
+        points = len(self.getSweepFrequencies())
+        spacing = SCPI.Linear.value if self.sweepType == Sweep.LINEAR else SCPI.Logarithmic.value
+        self.instrumentStepCount = None
+        self.instrumentDwell = None
+        self.sweepFrequencies = self.getStepSweepFrequencies(points)
+        setup = [
+            f'{SCPI.ListType.value} {SCPI.Step.value}',
+            f'{SCPI.ListTrigger.value} {SCPI.Immediate.value}',
+            f'{SCPI.FrequencyStart.value} {self.startFrequency} {Frequency.kHz.value}',
+            f'{SCPI.FrequencyStop.value} {self.stopFrequency} {Frequency.kHz.value}',
+            f'{SCPI.SweepPoints.value} {points}',
+            f'{SCPI.SweepSpacing.value} {spacing}',
+            f'{SCPI.SweepDwell.value} {self.stepDwell}',
+            f'{SCPI.InitiateContinuous.value} {SCPI.Off.value}',
+        ]
+        self.commandQueue.put((SCPI.SweepPoints, ';'.join(setup)))
+        self.commandQueue.put((SCPI.SweepDwell, ''))
+    
     def startFrequencySweep(self):
-        self.sweepThread = threading.Thread(target=self.sweepExponential, args=(self.startFrequency, self.stopFrequency, self.sweepTerm, self.stepDwell))
+        if self.sweepMode == SweepMode.LIST:
+            self.sweepThread = threading.Thread(target=self.sweepList, args=(self.getSweepFrequencies(), self.sweepPowers, self.stepDwell))
+        elif self.sweepMode == SweepMode.STEP:
+            self.sweepThread = threading.Thread(target=self.sweepStep)
+        else:
+            self.sweepThread = threading.Thread(target=self.sweepExponential, args=(self.startFrequency, self.stopFrequency, self.sweepTerm, self.stepDwell))
         self.runSweep = True
+        self.sweepStopEvent.clear()
         self.sweepThread.start()
         
     def stopFrequencySweep(self):
         self.runSweep = False
-        if self.sweepThread.is_alive() and self.sweepThread is not None:
+        # Wakes the sweep thread out of its dwell
+        self.sweepStopEvent.set()
+        if self.sweepThread is not None and self.sweepThread.is_alive():
             self.sweepThread.join()
 
+    def startCharacterisationScan(self, samples: SampleRingBuffer, reference_power: float = -20.0, settle: float = 0.5):
+        # Open loop scan of the sweep frequencies at a fixed power. settle is the fraction of
+        # the dwell left for the field to settle before the probe samples count.
+        self.sweepThread = threading.Thread(target=self.characterisationScan, args=(self.getSweepFrequencies(), samples, reference_power, self.stepDwell, settle))
+        self.runSweep = True
+        self.sweepStopEvent.clear()
+        self.sweepThread.start()
+        
+    def characterisationScan(self, frequencies, samples, reference_power, dwell, settle):
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        if len(frequencies) == 0:
+            self.error.emit('Characterisation scan has no frequencies')
+            self.sweepFinished.emit()
+            return
+        fields = np.full(len(frequencies), np.nan)
+        self.setPower(reference_power)
+        scheduler = self.beginSweepSchedule(dwell)
+        for point, frequency in enumerate(frequencies):
+            if not self.runSweep:
+                break
+            self.setFrequency(frequency, Frequency.kHz.value)
+            measure_from = scheduler.deadline() + settle * dwell
+            completed = scheduler.waitNext()
+            readings = samples.after(measure_from)
+            readings = readings[:np.searchsorted(readings[:, TIME], scheduler.deadline(), side='right')]
+            if len(readings) > 0:
+                fields[point] = np.median(readings[:, COMPOSITE])
+            self.sweepStatus.emit((point + 1) / len(frequencies) * 100)
+            if not completed:
+                break
+        self.sweepTiming.emit(scheduler.summary())
+        if not self.runSweep or point < len(frequencies) - 1:
+            # Stopped part way, a partial scan isn't kept but the sweep still ends
+            self.sweepFinished.emit()
+            return
+        with np.errstate(divide='ignore', invalid='ignore'):
+            transfer = np.where(fields > 0.0, 20.0 * np.log10(fields), np.nan) - reference_power
+        self.characterisationFinished.emit(frequencies * 1000.0, transfer)
+
+    def beginSweepSchedule(self, dwell: float) -> DeadlineScheduler:
+        self.sweepScheduler = DeadlineScheduler(dwell, self.sweepStopEvent, self.spinThreshold)
+        self.sweepScheduler.begin()
+        return self.sweepScheduler
+    
+    def getSweepLateness(self) -> list:
+        # Seconds each step of the last software sweep started after its deadline
+        return list(self.sweepScheduler.lateness) if self.sweepScheduler is not None else []
+
     def sweepLinear(self, start, stop, steps, dwell):
         traversal = stop - start
         step = traversal / steps
         current = start
+        scheduler = self.beginSweepSchedule(dwell)
         while current <= stop and self.runSweep:
             self.setFrequency(current, Frequency.kHz.value)
             current += step
             self.sweepStatus.emit((current - start) / (stop - start) * 100)
-            time.sleep(dwell)
+            if not scheduler.waitNext():
+                break
+        self.sweepTiming.emit(scheduler.summary())
         self.sweepFinished.emit()
     
 
@@ -602,11 +942,83 @@ class AgilentN5181A(QObject):
     def sweepExponential(self, start, stop, term, dwell):
         current = start
         print(f'Start: {start}, Ratio: {term}, Stop: {stop}')
+        scheduler = self.beginSweepSchedule(dwell)
         while current <= stop and self.runSweep:
             self.setFrequency(current, Frequency.kHz.value)
             current = current + (current * term)
             self.sweepStatus.emit(self.log_percentage(current, start, stop))
-            time.sleep(dwell)
+            if not scheduler.waitNext():
+                break
+        self.sweepTiming.emit(scheduler.summary())
+        self.sweepFinished.emit()
+    
+    def sweepList(self, frequencies, powers, dwell):
+        if len(frequencies) == 0 or len(frequencies) > MAX_LIST_POINTS:
+            self.error.emit(f'List sweep needs 1 to {MAX_LIST_POINTS} points, got {len(frequencies)}')
+            self.sweepFinished.emit()
+            return
+        if powers is not None and len(powers) != len(frequencies):
+            self.error.emit(f'List sweep has {len(frequencies)} frequencies but {len(powers)} powers')
+            self.sweepFinished.emit()
+            return
+        self.sweepFrequencies = frequencies
+        self.sweepPoint = -1
+        # Whole table goes over in one message, the instrument times every point itself
+        table = [
+            f'{SCPI.ListType.value} {SCPI.List.value}',
+            f'{SCPI.ListTrigger.value} {SCPI.Immediate.value}',
+            f'{SCPI.ListDwellType.value} {SCPI.Step.value}',
+            f'{SCPI.SweepDwell.value} {dwell}',
+            f'{SCPI.ListFrequency.value} {",".join(str(round(freq * 1000.0)) for freq in frequencies)}',
+        ]
+        if powers is not None:
+            table.append(f'{SCPI.ListPower.value} {",".join(str(round(pow, 2)) for pow in powers)}')
+            table.append(f'{SCPI.PowerMode.value} {SCPI.List.value}')
+        table.append(f'{SCPI.FrequencyMode.value} {SCPI.List.value}')
+        table.append(f'{SCPI.InitiateContinuous.value} {SCPI.Off.value}')
+        self.commandQueue.put((SCPI.ListPoints, ';'.join(table)))
+        self.runInstrumentSweep(dwell)
+        
+    def sweepStep(self):
+        if self.instrumentStepCount is None:
+            self.updateStepSweep()
+        self.sweepPoint = -1
+        self.commandQueue.put((SCPI.FrequencyMode, f'{SCPI.FrequencyMode.value} {SCPI.List.value}'))
+        self.runInstrumentSweep(self.stepDwell)
+        
+    def runInstrumentSweep(self, dwell: float):
+        # The instrument owns the timing, this thread only watches the point index. The write
+        # thread forgets the shadowed frequency and power when it sends INITiate.
+        self.commandQueue.put((SCPI.Initiate, SCPI.Initiate.value))
+        started = time.perf_counter()
+        now = started
+        finish = None
+        while self.runSweep:
+            # Readbacks can still change the point count or dwell once the sweep is running
+            step = self.instrumentDwell if self.instrumentDwell is not None else dwell
+            expected = len(self.sweepFrequencies) * step
+            if finish is not None:
+                wait = finish - now
+            elif now + self.sweepPollInterval < started + expected - step:
+                wait = self.sweepPollInterval
+            else:
+                wait = self.sweepEndPollInterval
+            self.sweepStopEvent.wait(max(wait, 0.0))
+            now = time.perf_counter()
+            if self.sweepPoint >= len(self.sweepFrequencies) - 1:
+                # Last point reached, let it dwell before handing the output back
+                if finish is None:
+                    finish = now + step
+                if now >= finish:
+                    break
+            elif now - started > expected + max(self.sweepTimeoutMargin, 0.25 * expected):
+                # A lost trigger, a dropped reply or ABORt from the front panel, the point index
+                # would never get there
+                self.error.emit(f'Sweep stuck at point {self.sweepPoint + 1} of {len(self.sweepFrequencies)} after {now - started:.1f} s, expected {expected:.1f} s')
+                break
+            else:
+                self.commandQueue.put((SCPI.SweepPoint, ''))
+        self.commandQueue.put((SCPI.FrequencyMode, f'{SCPI.Abort.value};{SCPI.FrequencyMode.value} {SCPI.Fixed.value};{SCPI.PowerMode.value} {SCPI.Fixed.value}'))
         self.sweepFinished.emit()
     
     def writeSCPI(self):
@@ -617,60 +1029,288 @@ class AgilentN5181A(QObject):
                 print("Blocking Loop until command Queue is empty.")
                 self.commandQueue.join()
             else:
-                command = self.commandQueue.get()
-                commandType = command[0]
-                commandValue = command[1]
-                if commandType == SCPI.Exit:
-                    print('Exiting write thread')
-                    break
-                self.instrument.write(commandValue)
-                complete = self.instrument.query(SCPI.OperationComplete.value)
-                #if complete:
+                try:
+                    command, enqueued = self.commandQueue.getTimed(timeout=self.syncPeriod)
+                except queue.Empty:
+                    command = None
+                try:
+                    if command is None:
+                        # Idle bus, confirm whatever is still outstanding
+                        if self.unconfirmed:
+                            self.syncPipeline()
+                        continue
+                    if command[0] == SCPI.Exit:
+                        if self.unconfirmed:
+                            self.syncPipeline()
+                        print('Exiting write thread')
+                        break
+                    self.writeCommand(command[0], command[1], enqueued)
+                except concurrent.futures.CancelledError:
+                    # closeConnection() cut the command short
+                    print(f'Cancelled: {command}')
+                except (TimeoutError, UnboundLocalError) as e:
+                    # socketscpi logs its socket.timeout and then fails returning the reply it never read
+                    if isinstance(e, UnboundLocalError) and self.backend != Backend.SOCKET:
+                        raise
+                    # Unknown whether the write landed
+                    self.invalidateShadowState()
+                    self.error.emit(f'Instrument timed out: {self.describeCommand(command) if command is not None else SCPI.OperationComplete.value}')
+                    if self.backend == Backend.SOCKET:
+                        try:
+                            self.reopenSocket()
+                        except (socketscpi.SockInstError, OSError) as e:
+                            self.error.emit(f'Connection lost: {str(e)}')
+                            self.is_running = False
+                except (ConnectionError, AsyncSockInstError, OSError) as e:
+                    self.invalidateShadowState()
+                    self.error.emit(f'Connection lost: {str(e)}')
+                    self.is_running = False
+                finally:
+                    if time.perf_counter() - self.lastStatsEmit >= self.statsInterval:
+                        self.latencyStats.emit(self.commandStats.snapshot())
+                        self.lastStatsEmit = time.perf_counter()
+                    
+    def reopenSocket(self):
+        # The missed reply is still on its way and would answer the next query, only a new
+        # connection puts queries and replies back in step. The asyncio backend drops it instead.
+        self.unconfirmed.clear()
+        self.unconfirmedCount = 0
+        self.unconfirmedWrites.clear()
+        try:
+            self.instrument.close()
+        except OSError as e:
+            print(f'Error on close: {str(e)}')
+        self.instrument = socketscpi.SocketInstrument(self.ip_address, self.port)
+        print(f'Reconnected to {self.instrument.instId}')
+                    
+    def writeCommand(self, commandType: SCPI, commandValue: str, enqueued: float):
+        dequeued = time.perf_counter()
+        self.commandStats.record(commandType, LatencyStage.QUEUED, dequeued - enqueued, dequeued)
+        if commandType in SHADOWED_COMMANDS:
+            shadow = self.shadowState.get(commandType)
+            if shadow is not None and shadow[0] == commandValue:
+                # Instrument already holds this, confirm it to the UI without touching the bus
+                self.shadowHits += 1
+                self.emitState(commandType, shadow[1])
+                emitted = time.perf_counter()
+                self.commandStats.record(commandType, LatencyStage.TOTAL, emitted - enqueued, emitted)
+                return
+            self.shadowMisses += 1
+            self.shadowState.pop(commandType, None)
+        if commandType == SCPI.Transaction:
+            self.writeTransaction(commandValue, enqueued, dequeued)
+            return
+        if commandType in WRITE_ONLY_COMMANDS:
+            # Confirm pipelined writes first, a later sync would shadow settings *RST or ABORt undid
+            if self.unconfirmed:
+                self.syncPipeline()
+            self.instrument.write(commandValue)
+            if commandType == SCPI.Reset:
+                self.invalidateShadowState()
+            elif commandType == SCPI.Initiate:
+                # A list or step sweep moves the output off the shadowed frequency and power
+                self.invalidateShadowState(SCPI.Frequency, SCPI.Power)
+            written = time.perf_counter()
+            self.commandStats.record(commandType, LatencyStage.WRITE, written - dequeued, written)
+            self.commandStats.record(commandType, LatencyStage.TOTAL, written - enqueued, written)
+            return
+        if commandValue == SCPI.Empty.value:
+            # Pure query, nothing to wait on
+            written = dequeued
+            state = self.instrument.query(f'{commandType.value}?')
+            acked = time.perf_counter()
+        elif self.transport == Transport.PIPELINED and commandType not in READBACK_COMMANDS:
+            self.instrument.write(commandValue)
+            written = time.perf_counter()
+            self.unconfirmed[commandType] = commandValue
+            self.unconfirmedCount += 1
+            # Acknowledged later by syncPipeline()
+            self.unconfirmedWrites.append((commandType, written))
+            state = self.expectedState(commandValue)
+            acked = None
+        else:
+            if self.unconfirmed:
+                self.syncPipeline()
+            self.instrument.write(commandValue)
+            written = time.perf_counter()
+            complete = self.instrument.query(SCPI.OperationComplete.value)
+            #if complete:
+            state = self.instrument.query(f'{commandType.value}?')
+            acked = time.perf_counter()
+            if commandType in SHADOWED_COMMANDS:
+                self.shadowState[commandType] = (commandValue, state)
+        self.emitState(commandType, state)
+        emitted = time.perf_counter()
+        if written != dequeued:
+            self.commandStats.record(commandType, LatencyStage.WRITE, written - dequeued, emitted)
+        if acked is not None:
+            self.commandStats.record(commandType, LatencyStage.ACK, acked - written, emitted)
+            self.commandStats.record(commandType, LatencyStage.EMIT, emitted - acked, emitted)
+        else:
+            self.commandStats.record(commandType, LatencyStage.EMIT, emitted - written, emitted)
+        self.commandStats.record(commandType, LatencyStage.TOTAL, emitted - enqueued, emitted)
+        if self.unconfirmedCount >= self.syncInterval or (self.unconfirmed and emitted - self.lastSync >= self.syncPeriod):
+            self.syncPipeline()
+                    
+    def describeCommand(self, command: tuple) -> str:
+        if command[0] == SCPI.Transaction:
+            return ';'.join(value for _, value in command[1])
+        return command[1]
+        
+    def writeTransaction(self, commandValue: list, enqueued: float, dequeued: float):
+        if self.unconfirmed:
+            self.syncPipeline()
+        settings = OrderedDict(commandValue)
+        applied = {}
+        for commandType, command in list(settings.items()):
+            shadow = self.shadowState.get(commandType)
+            if shadow is not None and shadow[0] == command:
+                self.shadowHits += 1
+                applied[commandType.name] = shadow[1]
+                del settings[commandType]
+            else:
+                self.shadowMisses += 1
+                self.shadowState.pop(commandType, None)
+        written = dequeued
+        acked = dequeued
+        if len(settings) > 0:
+            self.instrument.write(';'.join(settings.values()))
+            written = time.perf_counter()
+            # Completion, error status and every readback in a single round trip
+            queries = [SCPI.OperationComplete.value, SCPI.EventStatus.value] + [f'{commandType.value}?' for commandType in settings]
+            states = self.instrument.query(';'.join(queries)).split(';')
+            acked = time.perf_counter()
+            rejected = int(states[1]) & ESR_ERROR_MASK
+            if rejected:
+                for message in self.readErrors():
+                    self.error.emit(message)
+            for (commandType, command), state in zip(settings.items(), states[2:]):
+                if not rejected:
+                    self.shadowState[commandType] = (command, state)
+                applied[commandType.name] = state
+        self.configurationApplied.emit(applied)
+        emitted = time.perf_counter()
+        self.commandStats.record(SCPI.Transaction, LatencyStage.WRITE, written - dequeued, emitted)
+        self.commandStats.record(SCPI.Transaction, LatencyStage.ACK, acked - written, emitted)
+        self.commandStats.record(SCPI.Transaction, LatencyStage.EMIT, emitted - acked, emitted)
+        self.commandStats.record(SCPI.Transaction, LatencyStage.TOTAL, emitted - enqueued, emitted)
+                    
+    def syncPipeline(self):
+        # A single round trip waits for the pipelined writes and checks them for errors
+        status = self.instrument.query(f'{SCPI.OperationComplete.value};{SCPI.EventStatus.value}')
+        if int(status.split(';')[-1]) & ESR_ERROR_MASK:
+            for message in self.readErrors():
+                self.error.emit(message)
+            # Something in the batch was rejected, report what the instrument actually holds
+            self.invalidateShadowState()
+            for commandType in self.unconfirmed:
                 state = self.instrument.query(f'{commandType.value}?')
-                if commandType == SCPI.Identity: 
-                    self.instrumentConnected.emit(state)
-                elif commandType == SCPI.RFOut:
-                    self.rfOutSet.emit(bool(int(state)))
-                elif commandType == SCPI.Power:
-                    self.powerSet.emit(float(state))
-                elif commandType == SCPI.Frequency:
-                    self.frequencySet.emit(float(state))
-                elif commandType == SCPI.ModulationState:
-                    self.modStateSet.emit(bool(int(state)))
-                elif commandType == SCPI.AMState:
-                    self.modSubStateSet.emit(Modulation.AM.value, bool(int(state)))
-                elif commandType == SCPI.AMType:
-                    self.amTypeSet.emit(SCPI.Linear.value == state)
-                elif commandType == SCPI.AMMode:
-                    self.modModeSet.emit(Modulation.AM.value, SCPI.Normal.value == state)
-                elif commandType == SCPI.AMSource:
-                    self.modSourceSet.emit(Modulation.AM.value, SCPI.Internal.value == state)
-                elif commandType == SCPI.AMLinDepth:
-                    self.modDepthSet.emit(float(state))
-                elif commandType == SCPI.AMExpDepth:
-                    self.modDepthSet.emit(float(state))
-                elif commandType == SCPI.AMCoupling:
-                    self.modCouplingSet.emit(Modulation.AM.value, state == SCPI.AC.value)
-                elif commandType == SCPI.AMFreq:
-                    self.modFreqSet.emit(Modulation.AM.value, float(state))
-                elif commandType == SCPI.FMState:
-                    self.modSubStateSet.emit(Modulation.FM.value, bool(int(state)))
-                elif commandType == SCPI.FMSource:
-                    self.modSourceSet.emit(Modulation.FM.value, SCPI.Internal.value == state)
-                elif commandType == SCPI.FMCoupling:
-                    self.modCouplingSet(Modulation.FM.value, state == SCPI.AC.value)
-                elif commandType == SCPI.FMFreq:
-                    self.modFreqSet.emit(Modulation.FM.value, float(state))
-                elif commandType == SCPI.PMState:
-                    self.modSubStateSet.emit(Modulation.PM.value, bool(int(state)))
-                elif commandType == SCPI.PMBand:
-                    self.modModeSet.emit(Modulation.PM.value, SCPI.Normal.value == state)
-                elif commandType == SCPI.PMSource:
-                    self.modSourceSet.emit(Modulation.PM.value, SCPI.Internal.value == state)
-                elif commandType == SCPI.PMCoupling:
-                    self.modCouplingSet.emit(Modulation.PM.value, SCPI.AC.value == state)
-                elif commandType == SCPI.PMFreq:
-                    self.modFreqSet.emit(Modulation.PM.value, float(state))
+                self.emitState(commandType, state)
+        else:
+            for commandType, commandValue in self.unconfirmed.items():
+                if commandType in SHADOWED_COMMANDS:
+                    self.shadowState[commandType] = (commandValue, self.expectedState(commandValue))
+        acked = time.perf_counter()
+        for commandType, written in self.unconfirmedWrites:
+            self.commandStats.record(commandType, LatencyStage.ACK, acked - written, acked)
+        self.unconfirmed.clear()
+        self.unconfirmedCount = 0
+        self.unconfirmedWrites.clear()
+        self.lastSync = acked
+        
+    def getLatencyStats(self) -> dict:
+        return self.commandStats.summary()
+    
+    def dumpLatencyStats(self) -> str:
+        return self.commandStats.dump()
+    
+    def resetLatencyStats(self):
+        self.commandStats.reset()
+        
+    def readErrors(self) -> list:
+        errors = []
+        # The error queue holds at most 30 entries on the N5181A
+        for _ in range(30):
+            message = self.instrument.query(SCPI.SystemError.value)
+            if message.lstrip('+-').startswith('0,'):
+                break
+            errors.append(message)
+        return errors
+                    
+    def expectedState(self, commandValue: str) -> str:
+        # Mirror the readback the instrument would give for a setting command
+        arguments = commandValue.split(' ')[1:]
+        if len(arguments) == 0:
+            return ''
+        if arguments[0] == SCPI.On.value:
+            return '1'
+        if arguments[0] == SCPI.Off.value:
+            return '0'
+        if len(arguments) > 1 and arguments[1] in FREQUENCY_SCALE:
+            return str(float(arguments[0]) * FREQUENCY_SCALE[arguments[1]])
+        return arguments[0]
+        
+    def emitState(self, commandType: SCPI, state: str):
+        if commandType == SCPI.Identity: 
+            self.instrumentConnected.emit(state)
+        elif commandType == SCPI.RFOut:
+            self.rfOutSet.emit(bool(int(state)))
+        elif commandType == SCPI.Power:
+            self.powerSet.emit(float(state))
+        elif commandType == SCPI.Frequency:
+            self.frequencySet.emit(float(state))
+        elif commandType == SCPI.ModulationState:
+            self.modStateSet.emit(bool(int(state)))
+        elif commandType == SCPI.AMState:
+            self.modSubStateSet.emit(Modulation.AM.value, bool(int(state)))
+        elif commandType == SCPI.AMType:
+            self.amTypeSet.emit(SCPI.Linear.value == state)
+        elif commandType == SCPI.AMMode:
+            self.modModeSet.emit(Modulation.AM.value, SCPI.Normal.value == state)
+        elif commandType == SCPI.AMSource:
+            self.modSourceSet.emit(Modulation.AM.value, SCPI.Internal.value == state)
+        elif commandType == SCPI.AMLinDepth:
+            self.modDepthSet.emit(float(state))
+        elif commandType == SCPI.AMExpDepth:
+            self.modDepthSet.emit(float(state))
+        elif commandType == SCPI.AMCoupling:
+            self.modCouplingSet.emit(Modulation.AM.value, state == SCPI.AC.value)
+        elif commandType == SCPI.AMFreq:
+            self.modFreqSet.emit(Modulation.AM.value, float(state))
+        elif commandType == SCPI.FMState:
+            self.modSubStateSet.emit(Modulation.FM.value, bool(int(state)))
+        elif commandType == SCPI.FMSource:
+            self.modSourceSet.emit(Modulation.FM.value, SCPI.Internal.value == state)
+        elif commandType == SCPI.FMCoupling:
+            self.modCouplingSet.emit(Modulation.FM.value, state == SCPI.AC.value)
+        elif commandType == SCPI.FMFreq:
+            self.modFreqSet.emit(Modulation.FM.value, float(state))
+        elif commandType == SCPI.PMState:
+            self.modSubStateSet.emit(Modulation.PM.value, bool(int(state)))
+        elif commandType == SCPI.PMBand:
+            self.modModeSet.emit(Modulation.PM.value, SCPI.Normal.value == state)
+        elif commandType == SCPI.PMSource:
+            self.modSourceSet.emit(Modulation.PM.value, SCPI.Internal.value == state)
+        elif commandType == SCPI.PMCoupling:
+            self.modCouplingSet.emit(Modulation.PM.value, SCPI.AC.value == state)
+        elif commandType == SCPI.PMFreq:
+            self.modFreqSet.emit(Modulation.PM.value, float(state))
+        elif commandType == SCPI.ListPoints:
+            if int(float(state)) != len(self.sweepFrequencies):
+                self.error.emit(f'Instrument loaded {state} of {len(self.sweepFrequencies)} list points')
+        elif commandType == SCPI.SweepPoints:
+            self.instrumentStepCount = int(float(state))
+            if self.instrumentStepCount != len(self.sweepFrequencies):
+                # Instrument clamped the point count
+                self.sweepFrequencies = self.getStepSweepFrequencies(self.instrumentStepCount)
+        elif commandType == SCPI.SweepDwell:
+            self.instrumentDwell = float(state)
+        elif commandType == SCPI.SweepPoint:
+            point = min(max(int(float(state)), 0), len(self.sweepFrequencies) - 1)
+            if point != self.sweepPoint:
+                self.sweepPoint = point
+                self.frequencySet.emit(self.sweepFrequencies[point] * 1000.0)
+                self.sweepStatus.emit((point + 1) / len(self.sweepFrequencies) * 100)
     
                 
     def check_static_ip(self):
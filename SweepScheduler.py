@@ -0,0 +1,63 @@
+import threading
+import time
+from LatencyStats import LatencyHistogram
+
+
+class DeadlineScheduler():
+    # Paces sweep steps against absolute perf_counter deadlines, so the time spent queueing a
+    # step and emitting its status is taken out of the dwell instead of being added to it.
+
+    def __init__(self, period: float, stop_event: threading.Event = None, spin_threshold: float = 0.002):
+        self.period = period
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        # Sleep until this close to a deadline, then spin for the remainder
+        self.spin_threshold = spin_threshold
+        self.start = None
+        self.step = 0
+        self.lateness = []
+        self.histogram = LatencyHistogram()
+        self.reanchors = 0
+
+    def begin(self):
+        self.start = time.perf_counter()
+        self.step = 0
+        self.lateness = []
+        self.histogram.reset()
+        self.reanchors = 0
+
+    def deadline(self) -> float:
+        return self.start + self.step * self.period
+
+    def waitNext(self) -> bool:
+        # Returns False if the stop event fired before the next deadline
+        self.step += 1
+        deadline = self.deadline()
+        remaining = deadline - time.perf_counter()
+        if remaining > self.spin_threshold:
+            if self.stop_event.wait(remaining - self.spin_threshold):
+                return False
+        while time.perf_counter() < deadline:
+            if self.stop_event.is_set():
+                return False
+            # Yield the GIL to the SCPI and probe threads while spinning
+            time.sleep(0)
+        late = time.perf_counter() - deadline
+        self.lateness.append(late)
+        self.histogram.record(late)
+        if late > self.period:
+            # Fell a whole step behind, start a fresh schedule rather than rushing the next steps
+            self.start += late
+            self.reanchors += 1
+        return True
+
+    def summary(self) -> dict:
+        steps = len(self.lateness)
+        return {
+            'steps': steps,
+            'elapsed': time.perf_counter() - self.start if self.start is not None else 0.0,
+            'scheduled': self.step * self.period,
+            'mean_lateness': sum(self.lateness) / steps if steps > 0 else 0.0,
+            'p99_lateness': self.histogram.percentile(99.0),
+            'max_lateness': max(self.lateness) if steps > 0 else 0.0,
+            'reanchors': self.reanchors,
+        }
@@ -7,7 +7,7 @@ class CommandTest(QObject):
     def __init__(self, ipAdress = '192.168.100.79'):
         super(CommandTest, self).__init__()
         self.ipAdress = ipAdress
-        self.agilent = AgilentN5181A(self.ipAdress, 5024)
+        self.agilent = AgilentN5181A(self.ipAdress, 5025)
         self.agilent.instrumentDetected.connect(self.on_intrumentDetected)
         self.agilent.instrumentConnected.connect(self.on_instrumentConnected)
         self.agilent.error.connect(self.on_error)
@@ -28,7 +28,7 @@ class CommandTest(QObject):
         
     def resetIpAddress(self, address):
         self.ipAdress = address
-        self.agilent = AgilentN5181A(self.ipAdress, 5024)
+        self.agilent = AgilentN5181A(self.ipAdress, 5025)
         self.agilent.detect()
     
     @pyqtSlot(bool)    
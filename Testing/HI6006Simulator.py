@@ -0,0 +1,263 @@
+import argparse
+import math
+import os
+import pty
+import queue
+import random
+import select
+import sys
+import termios
+import threading
+import time
+import tty
+
+# termios speed constant -> baud rate
+SPEEDS = {getattr(termios, name): int(name[1:]) for name in dir(termios) if name[0] == 'B' and name[1:].isdigit()}
+
+# Start bit, 7 data bits, odd parity, stop bit
+BITS_PER_CHAR = 10
+
+# Command -> bytes it takes on the wire
+COMMAND_LENGTHS = {b'I': 1, b'D': 2, b'B': 2, b'T': 2}
+
+# Index into SerialCommand.ERRORS
+ERROR_COMMUNICATION = 1
+ERROR_BUFFER_FULL = 2
+ERROR_INVALID_COMMAND = 3
+ERROR_INVALID_PARAMETER = 4
+ERROR_HARDWARE = 5
+ERROR_PARITY = 6
+ERROR_PROBE_OFF = 7
+
+WAVEFORMS = ('constant', 'sine', 'square', 'ramp')
+
+
+class HI6006Probe():
+    # Field, battery and temperature model behind the simulated serial port
+
+    def __init__(self, level: float = 1.0, waveform: str = 'constant', amplitude: float = 0.0, period: float = 1.0,
+                 noise: float = 0.0, axes: tuple = (1.0, 1.0, 1.0), battery: int = 80, temperature: float = 72.0):
+        if waveform not in WAVEFORMS:
+            raise ValueError(f'Unknown waveform: {waveform}')
+        self.level = level
+        self.waveform = waveform
+        self.amplitude = amplitude
+        self.period = period
+        self.noise = noise
+        norm = math.sqrt(sum(axis * axis for axis in axes))
+        self.axes = tuple(axis / norm for axis in axes)
+        self.battery = battery
+        self.battery_fail = False
+        self.temperature = temperature
+        self.start = time.perf_counter()
+
+    def composite(self, now: float) -> float:
+        phase = ((now - self.start) / self.period) % 1.0
+        if self.waveform == 'sine':
+            offset = self.amplitude * math.sin(2 * math.pi * phase)
+        elif self.waveform == 'square':
+            offset = self.amplitude if phase < 0.5 else -self.amplitude
+        elif self.waveform == 'ramp':
+            offset = self.amplitude * (2.0 * phase - 1.0)
+        else:
+            offset = 0.0
+        return max(self.level + offset, 0.0)
+
+    def field(self, now: float) -> tuple:
+        composite = self.composite(now)
+        x, y, z = (max(composite * axis + random.gauss(0.0, self.noise), 0.0) for axis in self.axes)
+        return x, y, z, math.sqrt(x * x + y * y + z * z)
+
+
+def formatField(value: float) -> str:
+    # Five characters, resolution drops as the field grows
+    if value < 100.0:
+        return f'{value:05.2f}'
+    if value < 1000.0:
+        return f'{value:05.1f}'
+    return f'{min(value, 99999.0):05.0f}'
+
+
+class HI6006Simulator():
+    # Point ETSLindgrenHI6006(serial_port=simulator.port) at this instead of the probe. With a link
+    # path the port is a symlink to the pty, which keeps its name across blip().
+
+    def __init__(self, probe: HI6006Probe = None, baudrate: int = 9600, response_delay: float = 0.002,
+                 error_rate: float = 0.0, drop_rate: float = 0.0, garble_rate: float = 0.0, link: str = None):
+        self.probe = probe if probe is not None else HI6006Probe()
+        self.baudrate = baudrate
+        self.response_delay = response_delay
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.garble_rate = garble_rate
+        # Reply to every command with this error code, e.g. ERROR_PROBE_OFF
+        self.forced_error = None
+        self.link = link
+        self.openPty()
+        self.stop_event = threading.Event()
+        # The UART receives while it transmits, so commands are read on one thread and the
+        # replies go out in order on another
+        self.replies = queue.Queue()
+        self.receiver_thread = None
+        self.transmitter_thread = None
+        self.commands = 0
+        self.responses = 0
+
+    def openPty(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        if self.link is not None:
+            temporary = f'{self.link}.{os.getpid()}'
+            os.symlink(self.port, temporary)
+            os.replace(temporary, self.link)
+            self.port = self.link
+
+    def closePty(self):
+        os.close(self.master)
+        os.close(self.slave)
+        if self.link is not None and os.path.islink(self.link):
+            os.remove(self.link)
+
+    def blip(self, duration: float = 0.1):
+        # Drops off the bus like a USB adapter being pulled: reads on the old port fail, the port
+        # does not exist for duration, then a new pty appears behind the same link
+        self.stop()
+        time.sleep(duration)
+        self.openPty()
+        self.start()
+
+    def charTime(self) -> float:
+        return BITS_PER_CHAR / self.baudrate
+
+    def lineSpeed(self) -> int:
+        # The master shares the termios settings pyserial applies to the slave
+        return SPEEDS.get(termios.tcgetattr(self.master)[4], 0)
+
+    def start(self):
+        self.stop_event.clear()
+        self.receiver_thread = threading.Thread(target=self.receive, daemon=True)
+        self.transmitter_thread = threading.Thread(target=self.transmit, daemon=True)
+        self.receiver_thread.start()
+        self.transmitter_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in (self.receiver_thread, self.transmitter_thread):
+            if thread is not None:
+                thread.join()
+        self.closePty()
+
+    def receive(self):
+        buffer = b''
+        while not self.stop_event.is_set():
+            readable, _, _ = select.select([self.master], [], [], 0.05)
+            if not readable:
+                continue
+            try:
+                data = os.read(self.master, 256)
+            except OSError:
+                return
+            received = time.perf_counter()
+            if self.lineSpeed() != self.baudrate:
+                # Framing errors on both ends, the probe hears noise and answers with noise
+                buffer = b''
+                self.reply(bytes(random.randrange(0x20, 0x7f) for _ in range(len(data) * 3)), received)
+                continue
+            buffer += data
+            while len(buffer) > 0:
+                length = COMMAND_LENGTHS.get(buffer[:1])
+                if length is None:
+                    # Not the start of a command, answer it and resync on the next byte
+                    buffer = buffer[1:]
+                    self.reply(self.error(ERROR_INVALID_COMMAND), received)
+                    continue
+                if len(buffer) < length:
+                    break
+                command, buffer = buffer[:length], buffer[length:]
+                self.commands += 1
+                # The last byte of the command arrives a character time after it was sent
+                received += self.charTime() * length
+                self.reply(self.execute(command), received)
+
+    def execute(self, command: bytes) -> bytes:
+        if self.forced_error is not None:
+            return self.error(self.forced_error)
+        if random.random() < self.error_rate:
+            return self.error(random.choice((ERROR_COMMUNICATION, ERROR_BUFFER_FULL, ERROR_PARITY)))
+        status = 'F' if self.probe.battery_fail else 'N'
+        if command == b'I':
+            return f':I6006{"REV1.00.00":10}{"00123456":8}{"01012024":8}{status}\r'.encode()
+        if command == b'D5':
+            x, y, z, composite = self.probe.field(time.perf_counter())
+            return f':D{formatField(x)}{formatField(y)}{formatField(z)}{formatField(composite)}{status}\r'.encode()
+        if command == b'BP':
+            return f':B{self.probe.battery:02X}{status}\r'.encode()
+        if command == b'TF':
+            return f':T{self.probe.temperature:05.1f}\r'.encode()
+        return self.error(ERROR_INVALID_COMMAND)
+
+    def error(self, code: int) -> bytes:
+        return f':E{code}\r'.encode()
+
+    def reply(self, response: bytes, received: float):
+        if random.random() < self.drop_rate:
+            return
+        if random.random() < self.garble_rate:
+            position = random.randrange(1, len(response) - 1)
+            response = response[:position] + b'?' + response[position + 1:]
+        self.replies.put((response, received + self.response_delay))
+
+    def transmit(self):
+        line_free = 0.0
+        while not self.stop_event.is_set():
+            try:
+                response, ready = self.replies.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            # Send each character on its own deadline so reads see the line speed, a reply
+            # waits for the one ahead of it to finish
+            deadline = max(ready, line_free)
+            for i in range(len(response)):
+                deadline += self.charTime()
+                remaining = deadline - time.perf_counter()
+                if remaining > 0:
+                    time.sleep(remaining)
+                try:
+                    os.write(self.master, response[i:i + 1])
+                except OSError:
+                    return
+            line_free = deadline
+            self.responses += 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ETS-Lindgren HI-6006 serial simulator on a pseudo-terminal')
+    parser.add_argument('--level', type=float, default=1.0, help='Mean composite field in V/m')
+    parser.add_argument('--waveform', choices=WAVEFORMS, default='constant')
+    parser.add_argument('--amplitude', type=float, default=0.0, help='Waveform amplitude in V/m')
+    parser.add_argument('--period', type=float, default=1.0, help='Waveform period in seconds')
+    parser.add_argument('--noise', type=float, default=0.0, help='Standard deviation of per-axis noise in V/m')
+    parser.add_argument('--baudrate', type=int, default=9600)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability a command is answered with an error')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Probability a reply is never sent')
+    parser.add_argument('--garble-rate', type=float, default=0.0, help='Probability a reply has a corrupted character')
+    parser.add_argument('--link', help='Serve the pty behind this symlink, needed for --blip-every')
+    parser.add_argument('--blip-every', type=float, default=0.0, help='Drop the port every this many seconds')
+    parser.add_argument('--blip-duration', type=float, default=0.1, help='Seconds the port stays away on each drop')
+    args = parser.parse_args()
+    probe = HI6006Probe(args.level, args.waveform, args.amplitude, args.period, args.noise)
+    simulator = HI6006Simulator(probe, args.baudrate, error_rate=args.error_rate, drop_rate=args.drop_rate, garble_rate=args.garble_rate, link=args.link)
+    simulator.start()
+    print(f'HI-6006 simulator on {simulator.port}')
+    try:
+        while True:
+            if args.blip_every > 0 and args.link is not None:
+                time.sleep(args.blip_every)
+                simulator.blip(args.blip_duration)
+                print(f'Dropped {simulator.port} for {args.blip_duration} s')
+            else:
+                time.sleep(1.0)
+    except KeyboardInterrupt:
+        simulator.stop()
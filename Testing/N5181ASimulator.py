@@ -0,0 +1,246 @@
+import argparse
+import random
+import socketserver
+import sys
+import threading
+import time
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from SignalGenerator import SCPI, FREQUENCY_SCALE
+
+# Settings that read back as 1/0
+STATE_HEADERS = {SCPI.RFOut.value, SCPI.ModulationState.value, SCPI.AMState.value, SCPI.FMState.value, SCPI.PMState.value, SCPI.InitiateContinuous.value}
+
+# Settings that take a frequency and read back in Hz
+FREQUENCY_HEADERS = {SCPI.Frequency.value, SCPI.FrequencyStart.value, SCPI.FrequencyStop.value, SCPI.AMFreq.value, SCPI.FMFreq.value, SCPI.PMFreq.value}
+
+# Headers that trigger something instead of holding a value
+EVENT_HEADERS = {SCPI.Initiate.value, SCPI.Abort.value, '*RST', '*CLS'}
+
+# Headers that can only be queried
+QUERY_HEADERS = {SCPI.ListPoints.value, SCPI.SweepPoint.value, SCPI.SystemError.value.rstrip('?'), SCPI.EventStatus.value.rstrip('?'), SCPI.OperationComplete.value.rstrip('?'), SCPI.Identity.value}
+
+# *ESR? bits
+ESR_QUERY_ERROR = 0x04
+ESR_EXECUTION_ERROR = 0x10
+ESR_COMMAND_ERROR = 0x20
+
+IDENTITY = 'Agilent Technologies, N5181A, SIM00000001, A.01.80'
+
+DEFAULTS = {
+    SCPI.RFOut.value: '0',
+    SCPI.Frequency.value: '1000000000.0',
+    SCPI.Power.value: '-110.0',
+    SCPI.ModulationState.value: '1',
+    SCPI.AMState.value: '0',
+    SCPI.AMType.value: SCPI.Linear.value,
+    SCPI.AMMode.value: SCPI.Normal.value,
+    SCPI.AMSource.value: SCPI.Internal.value,
+    SCPI.AMCoupling.value: SCPI.DC.value,
+    SCPI.AMFreq.value: '400.0',
+    SCPI.AMLinDepth.value: '0.1',
+    SCPI.AMExpDepth.value: '0.1',
+    SCPI.FMState.value: '0',
+    SCPI.FMSource.value: SCPI.Internal.value,
+    SCPI.FMCoupling.value: SCPI.DC.value,
+    SCPI.FMFreq.value: '400.0',
+    SCPI.PMState.value: '0',
+    SCPI.PMSource.value: SCPI.Internal.value,
+    SCPI.PMBand.value: SCPI.Normal.value,
+    SCPI.PMCoupling.value: SCPI.DC.value,
+    SCPI.PMFreq.value: '400.0',
+    SCPI.ListType.value: SCPI.List.value,
+    SCPI.ListDwellType.value: SCPI.List.value,
+    SCPI.ListTrigger.value: SCPI.Immediate.value,
+    SCPI.SweepDwell.value: '0.002',
+    SCPI.SweepPoints.value: '101',
+    SCPI.SweepSpacing.value: SCPI.Linear.value,
+    SCPI.FrequencyStart.value: '100000000.0',
+    SCPI.FrequencyStop.value: '6000000000.0',
+    SCPI.FrequencyMode.value: SCPI.Fixed.value,
+    SCPI.PowerMode.value: SCPI.Fixed.value,
+    SCPI.InitiateContinuous.value: '0',
+}
+
+
+class N5181AInstrument():
+    # Instrument state shared by every connection, like the real front panel
+
+    def __init__(self, latency: float = 0.001, jitter: float = 0.0, error_rate: float = 0.0, latencies: dict = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        # Per-header overrides of latency
+        self.latencies = latencies if latencies is not None else {}
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.settings = dict(DEFAULTS)
+        self.list_frequencies = []
+        self.list_powers = []
+        self.errors = []
+        self.esr = 0
+        self.sweep_start = None
+        self.commands = 0
+
+    def delay(self, header: str):
+        time.sleep(self.latencies.get(header, self.latency) + random.uniform(0.0, self.jitter))
+
+    def pushError(self, bit: int, message: str):
+        # The N5181A keeps the 30 most recent errors
+        self.esr |= bit
+        self.errors = (self.errors + [message])[-30:]
+
+    def sweepFrequencies(self) -> list:
+        if self.settings[SCPI.ListType.value] == SCPI.List.value:
+            return self.list_frequencies
+        start = float(self.settings[SCPI.FrequencyStart.value])
+        stop = float(self.settings[SCPI.FrequencyStop.value])
+        points = max(int(float(self.settings[SCPI.SweepPoints.value])), 2)
+        if self.settings[SCPI.SweepSpacing.value] == SCPI.Logarithmic.value:
+            return [start * pow(stop / start, i / (points - 1)) for i in range(points)]
+        return [start + (stop - start) * i / (points - 1) for i in range(points)]
+
+    def sweepPoint(self) -> int:
+        frequencies = self.sweepFrequencies()
+        if self.sweep_start is None or len(frequencies) == 0:
+            return 0
+        dwell = float(self.settings[SCPI.SweepDwell.value])
+        return min(int((time.perf_counter() - self.sweep_start) / dwell), len(frequencies) - 1)
+
+    def execute(self, message: str) -> list:
+        # Runs one line, returns the answers to any queries in it
+        responses = []
+        with self.lock:
+            for unit in message.split(';'):
+                unit = unit.strip()
+                if unit == '':
+                    continue
+                header, _, argument = unit.partition(' ')
+                header = header.upper()
+                self.delay(header.rstrip('?'))
+                self.commands += 1
+                if header.endswith('?'):
+                    response = self.query(header[:-1])
+                    if response is not None:
+                        responses.append(response)
+                else:
+                    self.set(header, argument.strip())
+        return responses
+
+    def query(self, header: str) -> str:
+        if header == SCPI.Identity.value:
+            return IDENTITY
+        if header == SCPI.OperationComplete.value.rstrip('?'):
+            return '1'
+        if header == SCPI.EventStatus.value.rstrip('?'):
+            esr, self.esr = self.esr, 0
+            return str(esr)
+        if header == SCPI.SystemError.value.rstrip('?'):
+            return self.errors.pop(0) if self.errors else '+0,"No error"'
+        if header == SCPI.ListPoints.value:
+            return str(len(self.list_frequencies))
+        if header == SCPI.SweepPoint.value:
+            return str(self.sweepPoint())
+        if header == SCPI.ListFrequency.value:
+            return ','.join(str(freq) for freq in self.list_frequencies)
+        if header == SCPI.ListPower.value:
+            return ','.join(str(pow) for pow in self.list_powers)
+        if header == SCPI.Frequency.value and self.sweep_start is not None:
+            return str(self.sweepFrequencies()[self.sweepPoint()])
+        if header in self.settings:
+            return self.settings[header]
+        self.pushError(ESR_QUERY_ERROR, f'-113,"Undefined header;{header}?"')
+        return None
+
+    def set(self, header: str, argument: str):
+        if header == '*RST':
+            self.reset()
+            return
+        if header == '*CLS':
+            self.errors = []
+            self.esr = 0
+            return
+        if header == SCPI.Initiate.value:
+            if self.settings[SCPI.FrequencyMode.value] == SCPI.List.value:
+                self.sweep_start = time.perf_counter()
+            return
+        if header == SCPI.Abort.value:
+            self.sweep_start = None
+            return
+        if header in QUERY_HEADERS or (header not in self.settings and header not in (SCPI.ListFrequency.value, SCPI.ListPower.value)):
+            self.pushError(ESR_COMMAND_ERROR, f'-113,"Undefined header;{header}"')
+            return
+        if random.random() < self.error_rate:
+            self.pushError(ESR_EXECUTION_ERROR, f'-222,"Data out of range;{header} {argument}"')
+            return
+        try:
+            if header == SCPI.ListFrequency.value:
+                self.list_frequencies = [float(freq) for freq in argument.split(',')]
+            elif header == SCPI.ListPower.value:
+                self.list_powers = [float(pow) for pow in argument.split(',')]
+            elif header in STATE_HEADERS:
+                self.settings[header] = '1' if argument.upper() in (SCPI.On.value, '1') else '0'
+            elif header in FREQUENCY_HEADERS:
+                value, _, unit = argument.partition(' ')
+                self.settings[header] = str(float(value) * FREQUENCY_SCALE.get(unit.strip(), 1.0))
+            elif header == SCPI.FrequencyMode.value and argument.upper() != SCPI.List.value:
+                self.settings[header] = argument.upper()
+                self.sweep_start = None
+            else:
+                self.settings[header] = argument.split(' ')[0].upper()
+        except ValueError:
+            self.pushError(ESR_EXECUTION_ERROR, f'-224,"Illegal parameter value;{header} {argument}"')
+
+
+class SCPIHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            responses = self.server.instrument.execute(line.decode('latin_1'))
+            if responses:
+                self.wfile.write((';'.join(responses) + '\n').encode('latin_1'))
+
+
+class SCPIServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class N5181ASimulator():
+    # Point AgilentN5181A('127.0.0.1', port) at this instead of the generator
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 5025, **kwargs):
+        self.instrument = N5181AInstrument(**kwargs)
+        self.server = SCPIServer((host, port), SCPIHandler)
+        self.server.instrument = self.instrument
+        self.port = self.server.server_address[1]
+        self.server_thread = None
+
+    def start(self):
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.server_thread is not None:
+            self.server_thread.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Agilent N5181A SCPI simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5025)
+    parser.add_argument('--latency', type=float, default=0.001, help='Seconds of processing per command')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Extra uniformly random seconds per command')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability a setting is rejected')
+    args = parser.parse_args()
+    simulator = N5181ASimulator(args.host, args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    print(f'N5181A simulator listening on {args.host}:{simulator.port}')
+    try:
+        simulator.server.serve_forever()
+    except KeyboardInterrupt:
+        simulator.server.server_close()
@@ -0,0 +1,37 @@
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from FieldProbe import CompositeDataCommand
+
+RESPONSES = [b':D01.2302.3403.4504.56N\r', b':D123.4056.7009.1142.7N\r', b':D00.0000.0000.0000.00N\r']
+
+
+def parseString(command: CompositeDataCommand, response: bytes) -> tuple:
+    error, message = command.checkForError(response)
+    return command.parse(message)
+
+
+def parseBytes(command: CompositeDataCommand, response: bytes) -> tuple:
+    command.parseBytes(response)
+    return command.x, command.y, command.z, command.composite
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CompositeDataCommand response parsing, str path against bytes path')
+    parser.add_argument('--number', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for response in RESPONSES:
+        assert CompositeDataCommand().parseBytes(response), response
+        assert parseString(CompositeDataCommand(), response) == parseBytes(CompositeDataCommand(), response), response
+
+    command = CompositeDataCommand()
+
+    for function in (parseString, parseBytes):
+        for response in RESPONSES:
+            best = min(timeit.repeat(lambda: function(command, response), number=args.number, repeat=args.repeat))
+            print(f'{function.__name__:12} {response.decode().strip():24} {best / args.number * 1e6:6.3f} us/response')
@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from PyQt5.QtCore import QCoreApplication, Qt
+from SignalGenerator import AgilentN5181A, Backend, Frequency, SweepMode, Time
+from N5181ASimulator import N5181ASimulator
+
+
+def connectGenerator(port: int, backend: Backend, pipelined: bool) -> AgilentN5181A:
+    generator = AgilentN5181A('127.0.0.1', port)
+    generator.setBackend(backend)
+    generator.setTransport(pipelined)
+    generator.error.connect(lambda message: print(f'Error: {message}'), Qt.DirectConnection)
+    generator.connect()
+    return generator
+
+
+def measureThroughput(port: int, backend: Backend, pipelined: bool, count: int) -> float:
+    generator = connectGenerator(port, backend, pipelined)
+    # Every write has to reach the instrument for a fair count
+    generator.commandQueue.coalesce = set()
+    start = time.perf_counter()
+    for i in range(count):
+        generator.setFrequency(100.0 + i * 0.001, Frequency.MHz.value)
+    while generator.getQueueDepth() > 0:
+        time.sleep(0.001)
+    generator.stop()
+    return count / (time.perf_counter() - start)
+
+
+def measureSweep(port: int, mode: SweepMode, dwell_ms: float) -> tuple:
+    generator = connectGenerator(port, Backend.SOCKET, False)
+    finished = threading.Event()
+    generator.sweepFinished.connect(finished.set, Qt.DirectConnection)
+    generator.setSweepMode(mode)
+    generator.setSweepTerm(0.01)
+    generator.setStepDwell(dwell_ms, Time.Millisecond.value)
+    generator.setStartFrequency(100.0)
+    generator.setStopFrequency(200.0)
+    time.sleep(0.2)
+    expected = generator.getSweepTime()
+    start = time.perf_counter()
+    generator.startFrequencySweep()
+    finished.wait()
+    elapsed = time.perf_counter() - start
+    generator.stopFrequencySweep()
+    generator.stop()
+    return expected, elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='AgilentN5181A throughput and sweep timing against the simulator')
+    parser.add_argument('--latency', type=float, default=0.0002, help='Simulated seconds of processing per command')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--dwell', type=float, default=5.0, help='Sweep dwell in ms')
+    args = parser.parse_args()
+
+    app = QCoreApplication(sys.argv)
+    simulator = N5181ASimulator(port=0, latency=args.latency, jitter=args.jitter)
+    simulator.start()
+
+    for backend in (Backend.SOCKET, Backend.ASYNCIO):
+        for pipelined in (False, True):
+            rate = measureThroughput(simulator.port, backend, pipelined, args.count)
+            print(f'{backend.name:8} {"pipelined" if pipelined else "acknowledged":12} {rate:8.0f} commands/s')
+
+    for mode in (SweepMode.SOFTWARE, SweepMode.LIST, SweepMode.STEP):
+        expected, elapsed = measureSweep(simulator.port, mode, args.dwell)
+        print(f'{mode.name:8} sweep: estimated {expected:.3f} s, took {elapsed:.3f} s')
+
+    simulator.stop()
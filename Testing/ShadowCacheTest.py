@@ -0,0 +1,52 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from PyQt5.QtCore import QCoreApplication, Qt
+from SignalGenerator import AgilentN5181A, Backend, SCPI
+from N5181ASimulator import N5181ASimulator
+
+
+def connectGenerator(port: int, backend: Backend, pipelined: bool) -> AgilentN5181A:
+    generator = AgilentN5181A('127.0.0.1', port)
+    generator.setBackend(backend)
+    generator.setTransport(pipelined)
+    generator.error.connect(lambda message: print(f'Error: {message}'), Qt.DirectConnection)
+    generator.connect()
+    return generator
+
+
+def drain(generator: AgilentN5181A):
+    while generator.getQueueDepth() > 0:
+        time.sleep(0.001)
+    # Long enough for the write thread to go idle and confirm anything pipelined
+    time.sleep(generator.syncPeriod * 2)
+
+
+def testResetBetweenEqualSettings(simulator: N5181ASimulator, backend: Backend, pipelined: bool):
+    # A setting repeated after *RST must go out again, the reset put the instrument back to its defaults
+    generator = connectGenerator(simulator.port, backend, pipelined)
+    # Still unconfirmed in pipelined mode when the reset goes out
+    generator.setPower(-20.0)
+    generator.resetInstrument()
+    drain(generator)
+    generator.setPower(-20.0)
+    drain(generator)
+    generator.stop()
+    power = float(simulator.instrument.settings[SCPI.Power.value])
+    assert power == -20.0, f'{backend.name} {"pipelined" if pipelined else "acknowledged"}: power left at {power} dBm after reset'
+
+
+if __name__ == '__main__':
+    app = QCoreApplication(sys.argv)
+    simulator = N5181ASimulator(port=0, latency=0.0002)
+    simulator.start()
+
+    for backend in (Backend.SOCKET, Backend.ASYNCIO):
+        for pipelined in (False, True):
+            simulator.instrument.reset()
+            testResetBetweenEqualSettings(simulator, backend, pipelined)
+            print(f'{backend.name:8} {"pipelined" if pipelined else "acknowledged":12} reset between equal settings: ok')
+
+    simulator.stop()